@@ -1,11 +1,94 @@
 import json
 import argparse
-from nltk.tokenize import word_tokenize
+import itertools
+import logging
+import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from nltk.tokenize import sent_tokenize, word_tokenize
+from nltk.tokenize.destructive import NLTKWordTokenizer
 from utils import parse_args
 import os
-from typing import Dict, List
+from typing import Dict, Generator, List, Optional, TextIO, Tuple
 from tqdm import tqdm
 
+_word_tokenizer = NLTKWordTokenizer()
+_WHITESPACE = re.compile(r"\s*")
+# prefixes the tokenizers split like the whole text: a word (optionally with a comma, colon or semicolon) before a word
+# inside a sentence, and a word with at most one final mark before the start of a sentence. Other punctuation at the
+# end of a prefix may move sentence boundaries or be split differently (e.g. the final period rule of the tokenizer).
+_STABLE_PREFIX_END = re.compile(r"(?<!\S)[\w(\[{]+[,;:]?\s*$")
+_STABLE_SENTENCE_END = re.compile(r"(?<!\S)\w+[.!?]?\s*$")
+# a cut before a word character, after whitespace or an opening bracket. A cut before punctuation (e.g. the period
+# after an abbreviation) or inside a token (`gon|na`, `John|'s`) may move the sentence boundaries Punkt finds in the
+# prefix.
+_STABLE_CUT = re.compile(r"[\s(\[{]\w")
+
+
+class SpanMapper:
+    """
+    Maps character spans of a document to the positions of their words in `word_tokenize(text)`, the same positions
+    as `get_pos_span`, without tokenizing the text before every span.
+
+    The text is tokenized once, sentence by sentence like `word_tokenize`, with the character offset of every word
+    and sentence, and a span starting at a word is mapped by binary search over the offsets. Where tokenizing the
+    prefix alone could split it differently (a cut inside a token, before or after punctuation, see `_STABLE_CUT`
+    and `_STABLE_PREFIX_END`), or when the words cannot be aligned to the text, the prefix is tokenized like
+    `get_pos_span` does.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.words: List[str] = []
+        self._sentence_starts: List[int] = []
+        self._sentence_first_words: List[int] = []
+        self._word_starts: List[int] = []
+        self._aligned = True
+        cursor = 0
+        for sentence in sent_tokenize(text):
+            words = _word_tokenizer.tokenize(sentence)
+            start = text.find(sentence, cursor)
+            if self._aligned:
+                try:
+                    spans = list(_word_tokenizer.span_tokenize(sentence))
+                except ValueError:
+                    spans = []
+                self._aligned = start >= 0 and len(spans) == len(words)
+            if self._aligned:
+                self._sentence_starts.append(start)
+                self._sentence_first_words.append(len(self.words))
+                self._word_starts.extend(start + word_begin for word_begin, _ in spans)
+                cursor = start + len(sentence)
+            self.words.extend(words)
+
+    def begin_position(self, begin: int) -> int:
+        """
+        Returns `len(word_tokenize(text[:begin]))`, the position of the word starting at `begin`.
+        """
+        k = bisect_right(self._sentence_starts, begin) - 1
+        if not self._aligned or k < 0 or (begin > 0 and not _STABLE_CUT.match(self.text, begin - 1)):
+            return len(word_tokenize(self.text[:begin]))
+        sentence_start, first_word = self._sentence_starts[k], self._sentence_first_words[k]
+        if begin == sentence_start:
+            if _STABLE_SENTENCE_END.search(self.text, self._sentence_starts[k - 1] if k else 0, begin):
+                return first_word
+        else:
+            position = bisect_left(self._word_starts, begin)
+            if position < len(self._word_starts) and self._word_starts[position] == begin \
+                    and _STABLE_PREFIX_END.search(self.text, sentence_start, begin):
+                return position
+        # a cut the tokenizer may treat differently from the whole text
+        return len(word_tokenize(self.text[:begin]))
+
+    def get_pos_span(self, begin: int, end: int) -> tuple:
+        """
+        Same as `get_pos_span(text, begin, end)`.
+        """
+        begin_pos = self.begin_position(begin)
+        end_pos = begin_pos + len(word_tokenize(self.text[begin:end])) - 1
+        return begin_pos, end_pos
+
 
 def get_pos_span(text: str, begin: int, end: int) -> tuple:
     """
@@ -40,7 +123,8 @@ def process_1document(document: dict, freq_label: dict) -> list:
     list_of_entities = []
     entities_dict = document.get('entities', {})
     text = document.get('text', '')
-    words = word_tokenize(text)
+    mapper = SpanMapper(text)
+    words = mapper.words
     text_id = document.get('text_id')
     list_of_entities.append(f"# id {text_id}")
     
@@ -51,7 +135,7 @@ def process_1document(document: dict, freq_label: dict) -> list:
         
         entity = []
         for span in entity_dict.get('spans', []):
-            begin_pos, end_pos = get_pos_span(text, span['begin'], span['end'])
+            begin_pos, end_pos = mapper.get_pos_span(span['begin'], span['end'])
             entity.extend(words[begin_pos: end_pos + 1])
         
         entity_with_label = (' '.join(entity)).lower() + f" {label}"
@@ -61,74 +145,196 @@ def process_1document(document: dict, freq_label: dict) -> list:
     return list_of_entities
 
 
-def process_data(path_to_file: str, name_output_file: str, freq_labels: Dict[str, int]) -> None:
+def iter_json_array(path_to_file: str, read_size: int = 1 << 20) -> Generator[dict, None, None]:
+    """
+    Yields the elements of a JSON file holding one array of objects (like the RDRS `train.json`) one at a time,
+    reading the file in blocks of `read_size` characters instead of loading it whole.
     """
-    Reads a JSON file, processes each document in the file using the `process_1document` function,
-    and writes the extracted entities to an output file. It also calculates the frequency of each label
-    and writes it to a separate frequency file.
+    decoder = json.JSONDecoder()
+    with open(path_to_file, 'r', encoding='utf-8') as reader:
+        buffer, pos, at_end = '', 0, False
+
+        def next_char() -> str:
+            # skips whitespace, reading more of the file when the buffer is exhausted
+            nonlocal buffer, pos, at_end
+            pos = _WHITESPACE.match(buffer, pos).end()
+            while pos == len(buffer) and not at_end:
+                buffer, pos = reader.read(read_size), 0
+                at_end = not buffer
+                pos = _WHITESPACE.match(buffer, pos).end()
+            return buffer[pos:pos + 1]
+
+        if next_char() != '[':
+            raise ValueError(f"{path_to_file} does not hold a JSON array.")
+        pos += 1
+        if next_char() == ']':
+            return
+        while True:
+            next_char()
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                # a number may go on in the next block
+                if end == len(buffer) and not at_end:
+                    raise json.JSONDecodeError("Element cut by the block", buffer, end)
+            except json.JSONDecodeError:
+                more = reader.read(read_size)
+                if not more:
+                    raise ValueError(f"{path_to_file} ends inside the JSON array.") from None
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            pos = end
+            yield element
+            separator = next_char()
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"{path_to_file}: expected ',' or ']' after an element, got {separator!r}.")
+            pos += 1
+
+
+def _process_documents(documents: List[dict]) -> Tuple[str, Dict[str, int]]:
+    """
+    Converts a chunk of documents (see `process_1document`), in a worker process of `convert_rdrs_files`.
+    Returns the lines of the chunk and the frequency of its labels, in order of first occurrence.
+    """
+    freq_labels: Dict[str, int] = {}
+    lines = []
+    for document in documents:
+        lines.extend(f"{entity}\n" for entity in process_1document(document, freq_labels))
+        lines.append("\n")
+    return ''.join(lines), freq_labels
+
+
+def _write_atomic(path: str, text: str) -> None:
+    with open(path + '.tmp', 'w', encoding='utf-8') as writer:
+        writer.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def convert_rdrs_files(paths_to_files: List[str], name_output_file: str, executor: Optional[Executor] = None,
+                       documents_per_chunk: int = 64, max_in_flight: int = 32) -> Dict[str, int]:
+    """
+    Converts RDRS JSON files, in order, into the single output file `datasets/rdrs/{name_output_file}` and writes the
+    frequency of the labels to `datasets/rdrs/{name_output_file}_frequency.txt`.
+
+    The documents are streamed from the files (see `iter_json_array`) in chunks of `documents_per_chunk`, converted in
+    the processes of `executor` (in this process without one) with at most `max_in_flight` chunks submitted ahead, and
+    written in order, so the output does not depend on the number of processes. Both files are written to a temporary
+    file and renamed when complete: a rerun replaces them and an interrupted run leaves the previous ones.
 
     Args:
-        path_to_file: The path to the input JSON file.
-        name_output_file: The name of the output file.
+        paths_to_files (List[str]): The RDRS JSON files.
+        name_output_file (str): The name of the output file.
+        executor (Executor, optional): The process pool converting the chunks, possibly shared by several outputs.
+        documents_per_chunk (int): The number of documents sent to a process at a time.
+        max_in_flight (int): The maximum number of chunks submitted and not yet written.
 
     Returns:
-        None
+        Dict[str, int]: The frequency of every label, in order of first occurrence.
     """
     output_dir = os.path.join(os.getcwd(), 'datasets/rdrs/')
     os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, name_output_file)
+    freq_labels: Dict[str, int] = {}
+    documents = (document for path_to_file in paths_to_files for document in iter_json_array(path_to_file))
+    chunks = iter(lambda: list(itertools.islice(documents, documents_per_chunk)), [])
+    pending = deque()
 
-    with open(path_to_file, 'r', encoding='utf-8') as reader:
-        with open(os.path.join(output_dir, name_output_file), 'a', encoding='utf-8') as writer:
-            data = json.load(reader)
-            for document in tqdm(data, desc=f"Processing {name_output_file}"):
-                entities = process_1document(document, freq_labels)
-                for entity in entities:
-                    writer.write(f"{entity}\n")
-                writer.write("\n")
+    def write_chunk(writer: TextIO, n_documents: int, text: str, chunk_freq_labels: Dict[str, int]) -> None:
+        writer.write(text)
+        for label, freq in chunk_freq_labels.items():
+            freq_labels[label] = freq_labels.get(label, 0) + freq
+        progress.update(n_documents)
 
+    with open(output_path + '.tmp', 'w', encoding='utf-8') as writer, tqdm(desc=f"Processing {name_output_file}", unit=" docs") as progress:
+        for chunk in chunks:
+            if executor is None:
+                write_chunk(writer, len(chunk), *_process_documents(chunk))
+                continue
+            pending.append((len(chunk), executor.submit(_process_documents, chunk)))
+            if len(pending) >= max_in_flight:
+                n_documents, future = pending.popleft()
+                write_chunk(writer, n_documents, *future.result())
+        while pending:
+            n_documents, future = pending.popleft()
+            write_chunk(writer, n_documents, *future.result())
+    os.replace(output_path + '.tmp', output_path)
+    _write_atomic(os.path.join(output_dir, f"{name_output_file}_frequency.txt"), ''.join(f"{label} {freq}\n" for label, freq in freq_labels.items()))
+    return freq_labels
 
-def merge_and_convert_rdrs(path_to_rdrs_dir: str, name_output_file: str):
-    freq_labels: Dict[str, int] = {}
-    output_dir = os.path.join(os.getcwd(), 'datasets/rdrs/')
-    os.makedirs(output_dir, exist_ok=True)
+
+def process_data(path_to_file: str, name_output_file: str, freq_labels: Dict[str, int], executor: Optional[Executor] = None) -> None:
+    """
+    Converts one RDRS JSON file into `datasets/rdrs/{name_output_file}` (see `convert_rdrs_files`) and adds the
+    frequency of its labels to `freq_labels`.
+
+    Args:
+        path_to_file: The path to the input JSON file.
+        name_output_file: The name of the output file.
+        freq_labels: The frequency of each label, updated in place.
+        executor: The process pool converting the documents.
+
+    Returns:
+        None
+    """
+    for label, freq in convert_rdrs_files([path_to_file], name_output_file, executor).items():
+        freq_labels[label] = freq_labels.get(label, 0) + freq
+
+
+def _merged_input_files(path_to_rdrs_dir: str) -> List[str]:
     path_to_rdrs_dir = os.path.join(path_to_rdrs_dir, "1")
     if not os.path.isdir(path_to_rdrs_dir):
         raise ValueError(f"Error: {path_to_rdrs_dir} is not a directory.")
-
     # List all files in the directory
-    for file_name in os.listdir(path_to_rdrs_dir):
-        print(file_name)
-        file_path = os.path.join(path_to_rdrs_dir, file_name)
-        
-        # Check if it's a file before processing
-        if os.path.isfile(file_path):
-            process_data(file_path, name_output_file, freq_labels)
-    
-    with open(os.path.join(output_dir, f"{name_output_file}_frequency.txt"), 'w', encoding='utf-8') as writer:
-        for label, freq in freq_labels.items():
-            writer.write(f"{label} {freq}\n")
+    paths = [os.path.join(path_to_rdrs_dir, file_name) for file_name in os.listdir(path_to_rdrs_dir)]
+    return [path for path in paths if os.path.isfile(path)]
 
 
-def process_all_fold(path_to_folds_dir):
-    output_base_dir = os.path.join(os.getcwd(), 'datasets/rdrs/')
-    for num, dir_name in enumerate(os.listdir(path_to_folds_dir), start=1):
+def _fold_jobs(path_to_folds_dir: str) -> List[Tuple[List[str], str]]:
+    jobs = []
+    for dir_name in os.listdir(path_to_folds_dir):
         dir_path = os.path.join(path_to_folds_dir, dir_name)
         if os.path.isdir(dir_path):
             train_file_path = os.path.join(dir_path, 'train.json')
-            freq_labels = {}
-            if os.path.exists(train_file_path):
-                process_data(train_file_path, f'rdrs{dir_name}', freq_labels)
-            with open(os.path.join(output_base_dir, f"rdrs{dir_name}_frequency.txt"), 'w', encoding='utf-8') as writer:
-                for label, freq in freq_labels.items():
-                    writer.write(f"{label} {freq}\n")
+            if not os.path.exists(train_file_path):
+                logging.warning(f"Skipping fold {dir_name}: {train_file_path} does not exist.")
+                continue
+            jobs.append(([train_file_path], f'rdrs{dir_name}'))
+    return jobs
+
+
+def merge_and_convert_rdrs(path_to_rdrs_dir: str, name_output_file: str, executor: Optional[Executor] = None) -> None:
+    """
+    Converts all the files of the first fold directory (train, dev and test) into one corpus `name_output_file`.
+    """
+    convert_rdrs_files(_merged_input_files(path_to_rdrs_dir), name_output_file, executor)
+
+
+def process_all_fold(path_to_folds_dir: str, executor: Optional[Executor] = None) -> None:
+    """
+    Converts the `train.json` of every fold directory `<n>` into `rdrs<n>`.
+    """
+    for paths_to_files, name_output_file in _fold_jobs(path_to_folds_dir):
+        convert_rdrs_files(paths_to_files, name_output_file, executor)
+
+
+def preprocess_rdrs(path_to_rdrs_dir: str, processes: int = os.cpu_count() or 1) -> None:
+    """
+    Converts the merged corpus `rdrs` and the five folds `rdrs1`..`rdrs5` concurrently: every output streams its
+    documents through one shared pool of `processes` processes, so the whole layout takes about as long as its
+    largest output instead of the sum of all of them.
+    """
+    jobs = [(_merged_input_files(path_to_rdrs_dir), "rdrs")] + _fold_jobs(path_to_rdrs_dir)
+    with ProcessPoolExecutor(max_workers=processes) as executor, ThreadPoolExecutor(max_workers=len(jobs)) as outputs:
+        futures = [outputs.submit(convert_rdrs_files, paths_to_files, name_output_file, executor) for paths_to_files, name_output_file in jobs]
+        for future in futures:
+            future.result()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process RDRS training data.', add_help=False)
     parser.add_argument('--dir', type=str, help='Path to 1 of 5 dir of RDRS')
+    parser.add_argument('--processes', type=int, help='Number of processes converting the documents of all outputs.', default=os.cpu_count() or 1)
     # dir has form `RDRS-main/data/interim`
     sg = parser.parse_args()
-    merge_and_convert_rdrs(sg.dir, "rdrs")
-    process_all_fold(sg.dir)
-
-
+    preprocess_rdrs(sg.dir, sg.processes)
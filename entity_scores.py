@@ -0,0 +1,380 @@
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import shared_memory
+from typing import Dict, Generator, Iterable, List, Optional, TextIO, Tuple
+from gazetteer_writer import GazetteerWriter
+from similarity import LabelSimilarityEngine
+from topic_vectors import TopicKey
+
+
+class EntityScores:
+    """
+    The maximum similarity of every entity to every label (any topic of the entity against any synonym of the label),
+    one row per entity in gazetteer order. A gazetteer for any threshold is a comparison against this matrix,
+    so many thresholds are written from a single similarity pass.
+
+    The matrix is cached on disk as float16 (about 3 significant digits).
+
+    `ranks` are the positions of the entities in the gazetteer order of the whole dataset (see
+    `ner_store.NERStore.iter_ranked_entities`), by which the partial gazetteers of shards are merged.
+    """
+
+    def __init__(self, entities: List[str], tags: List[str], labels: List[str], scores: np.ndarray, fingerprint: str = "",
+                 ranks: Optional[List[int]] = None):
+        self.entities = entities
+        self.tags = tags
+        self.labels = labels
+        self.scores = scores
+        self.fingerprint = fingerprint
+        self.ranks = ranks
+
+    @classmethod
+    def load(cls, path: str) -> "EntityScores":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            return cls(meta["entities"], meta["tags"], meta["labels"], data["scores"], meta["fingerprint"], meta.get("ranks"))
+
+    def save(self, path: str) -> None:
+        """
+        Writes the matrix as float16 with the entities, tags and labels (temp file plus rename).
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = json.dumps({"entities": self.entities, "tags": self.tags, "labels": self.labels, "fingerprint": self.fingerprint,
+                           "ranks": self.ranks}, ensure_ascii=False)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, scores=self.scores.astype(np.float16), meta=np.asarray(meta))
+        os.replace(tmp_path, path)
+
+    def true_tag_scores(self) -> np.ndarray:
+        """
+        Returns the score of every entity for its true tag, -inf when the tag is not one of the labels.
+        """
+        columns = self.label_columns()
+        scores = np.full(len(self.entities), -np.inf, dtype=np.float32)
+        known = columns >= 0
+        scores[known] = self.scores[np.flatnonzero(known), columns[known]]
+        return scores
+
+    def label_columns(self) -> np.ndarray:
+        """
+        Returns the column of the true tag of every entity, -1 when the tag is not one of the labels.
+        """
+        label_index = {label: j for j, label in enumerate(self.labels)}
+        return np.asarray([label_index.get(tag, -1) for tag in self.tags], dtype=np.int64)
+
+    def write_gazetteers(self, directory_path: str, threshold: float, sort: bool = False) -> Dict[str, int]:
+        """
+        Writes `<label>.txt` with the entities scoring at least `threshold` for the label (in entity order or sorted,
+        only for labels with at least one entity) through a `GazetteerWriter`, and `coverage.txt` with the number of
+        entities added to the gazetteer of their true tag, tags in the order their first entity was added.
+
+        Returns:
+            Dict[str, int]: The coverage per true tag.
+        """
+        with GazetteerWriter(directory_path, sort, other_files=["coverage.txt"]) as writer:
+            for j, label in enumerate(self.labels):
+                rows = np.flatnonzero(np.asarray(self.scores[:, j], dtype=np.float32) >= threshold)
+                writer.add_many(label, (self.entities[row] for row in rows))
+
+        coverage = {}
+        for row in np.flatnonzero(self.true_tag_scores() >= threshold):
+            coverage[self.tags[row]] = coverage.get(self.tags[row], 0) + 1
+        _write_lines(os.path.join(directory_path, "coverage.txt"), (f"{key} {value}\n" for key, value in coverage.items()))
+        return coverage
+
+    def write_partial_gazetteers(self, directory_path: str, threshold: float) -> None:
+        """
+        Writes the gazetteers of `write_gazetteers` for the entities of one shard, to be merged by
+        `merge_partial_gazetteers`: `<label>.txt` with `rank\tentity` lines and, last, `coverage.txt` with
+        `rank\ttag\tcount` lines, the rank of a tag being the rank of its first entity in the shard.
+        """
+        if self.ranks is None:
+            raise ValueError("Partial gazetteers need the ranks of the entities, the scores must be recomputed.")
+        # a partial gazetteer of an earlier run must not be merged with this one, nor look complete while written
+        shutil.rmtree(directory_path, ignore_errors=True)
+        with GazetteerWriter(directory_path) as writer:
+            for j, label in enumerate(self.labels):
+                rows = np.flatnonzero(np.asarray(self.scores[:, j], dtype=np.float32) >= threshold)
+                writer.add_many(label, (f"{self.ranks[row]}\t{self.entities[row]}" for row in rows))
+
+        coverage = {}
+        for row in np.flatnonzero(self.true_tag_scores() >= threshold):
+            first, count = coverage.get(self.tags[row], (self.ranks[row], 0))
+            coverage[self.tags[row]] = (first, count + 1)
+        _write_lines(os.path.join(directory_path, "coverage.txt"), (f"{first}\t{tag}\t{count}\n" for tag, (first, count) in coverage.items()))
+
+
+def _write_lines(path: str, lines: Iterable[str]) -> None:
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        file.writelines(lines)
+    os.replace(path + '.tmp', path)
+
+
+def _read_partial(file: TextIO) -> Generator[Tuple[int, str], None, None]:
+    for line in file:
+        rank, entry = line.rstrip('\n').split('\t', 1)
+        yield int(rank), entry
+
+
+def merge_partial_gazetteers(partial_directories: List[str], directory_path: str, sort: bool = False) -> Dict[str, int]:
+    """
+    Merges the partial gazetteers of all the shards of a build (see `EntityScores.write_partial_gazetteers`) into the
+    gazetteer `write_gazetteers` writes for the whole dataset. Every `<label>.txt` is a k-way merge of the shards by
+    rank, so the output does not depend on the number of shards; `coverage.txt` sums the counts of the shards.
+
+    Args:
+        partial_directories (List[str]): The partial gazetteer directories, one per shard.
+        directory_path (str): The gazetteer directory to write.
+        sort (bool): Whether the gazetteer files are sorted instead of in entity order.
+
+    Returns:
+        Dict[str, int]: The coverage per true tag.
+    """
+    for partial_directory in partial_directories:
+        if not os.path.isfile(os.path.join(partial_directory, "coverage.txt")):
+            raise FileNotFoundError(f"The partial gazetteer is missing or incomplete: {partial_directory}")
+    labels = sorted({filename[:-4] for partial_directory in partial_directories for filename in os.listdir(partial_directory)
+                     if filename.endswith(".txt") and filename != "coverage.txt"})
+    with GazetteerWriter(directory_path, sort, other_files=["coverage.txt"]) as writer:
+        for label in labels:
+            with ExitStack() as stack:
+                files = [stack.enter_context(open(os.path.join(partial_directory, f"{label}.txt"), 'r', encoding='utf-8'))
+                         for partial_directory in partial_directories if os.path.isfile(os.path.join(partial_directory, f"{label}.txt"))]
+                writer.add_many(label, (entry for _, entry in heapq.merge(*(_read_partial(file) for file in files))))
+
+    coverage = {}
+    for partial_directory in partial_directories:
+        with open(os.path.join(partial_directory, "coverage.txt"), 'r', encoding='utf-8') as file:
+            for rank, tag, count in (line.rstrip('\n').split('\t') for line in file):
+                first, total = coverage.get(tag, (int(rank), 0))
+                coverage[tag] = (min(first, int(rank)), total + int(count))
+    coverage = {tag: total for tag, (_, total) in sorted(coverage.items(), key=lambda item: item[1][0])}
+    _write_lines(os.path.join(directory_path, "coverage.txt"), (f"{key} {value}\n" for key, value in coverage.items()))
+    return coverage
+
+
+# (shared memory name, shape, dtype) of an array shared with the scoring workers
+SharedArraySpec = Tuple[str, Tuple[int, ...], str]
+# the state of a scoring worker process, set by `_init_scoring_worker`
+_worker: Dict[str, object] = {}
+
+
+def _share_array(array: np.ndarray) -> Tuple[shared_memory.SharedMemory, SharedArraySpec]:
+    """
+    Copies an array into a new shared memory block, which the caller must unlink.
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_array(spec: SharedArraySpec) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _init_scoring_worker(label_spec: SharedArraySpec, topic_spec: SharedArraySpec, labels: List[str], synonyms: Dict[str, List[str]], offsets: np.ndarray) -> None:
+    """
+    Attaches a worker process to the label and topic matrices in shared memory (zero-copy).
+    """
+    label_shm, label_matrix = _attach_array(label_spec)
+    topic_shm, topic_matrix = _attach_array(topic_spec)
+    # the SharedMemory objects are kept alive as long as the arrays that use their buffers
+    _worker.update(shms=(label_shm, topic_shm), topics=topic_matrix,
+                   engine=LabelSimilarityEngine.from_matrix(labels, synonyms, offsets, label_matrix))
+
+
+def _score_topic_chunk(start: int, texts: List[str]) -> np.ndarray:
+    engine: LabelSimilarityEngine = _worker["engine"]
+    return engine.score(_worker["topics"][start:start + len(texts)], texts)[0]
+
+
+def _score_topics(engine: LabelSimilarityEngine, topic_matrix: np.ndarray, texts: List[str], chunk_size: int, processes: int) -> np.ndarray:
+    """
+    Scores every topic against every label in chunks of `chunk_size` topics, with `processes` > 1 in a process pool
+    that shares the label and topic matrices through `multiprocessing.shared_memory`. The chunks are the same either
+    way and their results are placed by position, so the scores do not depend on the number of processes.
+    """
+    topic_scores = np.empty((len(texts), len(engine.labels)), dtype=np.float32)
+    starts = range(0, len(texts), chunk_size)
+    if processes <= 1 or len(starts) <= 1:
+        for start in starts:
+            topic_scores[start:start + chunk_size], _ = engine.score(topic_matrix[start:start + chunk_size], texts[start:start + chunk_size])
+        return topic_scores
+
+    label_shm, label_spec = _share_array(engine.matrix)
+    topic_shm, topic_spec = _share_array(np.asarray(topic_matrix, dtype=np.float32).reshape(len(texts), engine.dim))
+    try:
+        with ProcessPoolExecutor(max_workers=min(processes, len(starts)), initializer=_init_scoring_worker,
+                                 initargs=(label_spec, topic_spec, engine.labels, engine.synonyms, engine.offsets)) as executor:
+            chunks = executor.map(_score_topic_chunk, starts, [texts[start:start + chunk_size] for start in starts])
+            for start, chunk_scores in zip(starts, chunks):
+                topic_scores[start:start + chunk_size] = chunk_scores
+    finally:
+        for shm in (label_shm, topic_shm):
+            shm.close()
+            shm.unlink()
+    return topic_scores
+
+
+def score_entities(engine: LabelSimilarityEngine, entity_topics: List[Dict[str, str]], topic_matrix: np.ndarray,
+                   topic_rows: Dict[TopicKey, int], chunk_size: int = 4096, processes: int = 1) -> np.ndarray:
+    """
+    Scores entities against every label. Each distinct topic is scored once (in chunks of `chunk_size` topics,
+    spread over `processes` worker processes), then the scores of the topics of an entity are reduced to their maximum.
+
+    Args:
+        engine (LabelSimilarityEngine): The label synonyms.
+        entity_topics (List[Dict[str, str]]): The `wiki_topics` ({topic: QID}) of every entity.
+        topic_matrix (np.ndarray): The topic vectors, see `topic_vectors.embed_topics`.
+        topic_rows (Dict[TopicKey, int]): The row of each (QID, topic) in `topic_matrix`.
+        chunk_size (int): The number of topics scored in one matrix multiply.
+        processes (int): The number of scoring processes.
+
+    Returns:
+        np.ndarray: float32 matrix of shape (len(entity_topics), n_labels), -inf for entities without topics.
+    """
+    texts = [None] * len(topic_rows)
+    for (_, topic), row in topic_rows.items():
+        texts[row] = topic
+    topic_scores = _score_topics(engine, topic_matrix, texts, chunk_size, processes)
+
+    scores = np.full((len(entity_topics), len(engine.labels)), -np.inf, dtype=np.float32)
+    lengths = np.asarray([len(topics) for topics in entity_topics], dtype=np.int64)
+    rows = np.asarray([topic_rows[(qid, topic)] for topics in entity_topics for topic, qid in topics.items()], dtype=np.int64)
+    has_topics = np.flatnonzero(lengths)
+    if len(has_topics) and len(engine.labels):
+        starts = (np.cumsum(lengths) - lengths)[has_topics]
+        scores[has_topics] = np.maximum.reduceat(topic_scores[rows], starts, axis=0)
+    return scores
+
+
+def scores_fingerprint(model_name: str, paths: List[str], extra: str = "") -> str:
+    """
+    Identifies the inputs of a score matrix: the model, the content of the given files
+    (dataset, NER and docs dicts, label synonyms) and any other setting given as `extra`.
+    """
+    digest = hashlib.sha256(f"{model_name}|{extra}".encode('utf-8'))
+    for path in paths:
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_cached_scores(path: str, fingerprint: str) -> Optional[EntityScores]:
+    """
+    Returns the cached score matrix at `path` if it was computed from the same inputs.
+    """
+    if not os.path.isfile(path):
+        return None
+    scores = EntityScores.load(path)
+    return scores if scores.fingerprint == fingerprint else None
+
+
+def parse_thresholds(values: List[str]) -> List[float]:
+    """
+    Parses a list of thresholds, each value either a number or an inclusive range `start:stop:step`
+    (e.g. `0.5:0.95:0.05`). Raises ValueError for a range with a step that is not positive or a stop below its start.
+    """
+    thresholds = []
+    for value in values:
+        if ':' in value:
+            try:
+                start, stop, step = (float(part) for part in value.split(':'))
+            except ValueError:
+                raise ValueError(f"A threshold range is given as start:stop:step, got {value!r}") from None
+            if step <= 0:
+                raise ValueError(f"The step of a threshold range must be positive, got {value!r}")
+            if stop < start:
+                raise ValueError(f"The stop of a threshold range must not be below its start, got {value!r}")
+            thresholds.extend(round(start + i * step, 6) for i in range(int(round((stop - start) / step)) + 1))
+        else:
+            thresholds.append(float(value))
+    return list(dict.fromkeys(thresholds))
+
+
+def precision_recall_curve(scores: np.ndarray, positives: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    Precision and recall of accepting every entity scoring at least t, for every distinct finite score t.
+
+    Args:
+        scores (np.ndarray): The scores of the entities for one label.
+        positives (np.ndarray): Whether each entity has the label as its true tag.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, int]: The thresholds (descending), the precision and the recall
+            at each threshold, and the number of positives.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    n_positives = int(positives.sum())
+    finite = np.isfinite(scores)
+    order = np.argsort(-scores[finite], kind='stable')
+    sorted_scores = scores[finite][order]
+    if len(sorted_scores) == 0:
+        empty = np.zeros(0, dtype=np.float64)
+        return sorted_scores, empty, empty, n_positives
+    true_positives = np.cumsum(positives[finite][order])
+    # the last entity of every group of equal scores: accepting t accepts the whole group
+    last = np.flatnonzero(np.append(sorted_scores[1:] != sorted_scores[:-1], True))
+    accepted = last + 1
+    precision = true_positives[last] / accepted
+    recall = true_positives[last] / max(n_positives, 1)
+    return sorted_scores[last], precision, recall, n_positives
+
+
+def tune_thresholds(scores: EntityScores, beta: float = 1.0) -> Dict[str, Dict[str, float]]:
+    """
+    Recommends a threshold per label: the one with the highest F-beta of the label's gazetteer against the training tags,
+    where recall is the coverage of the label (`coverage.txt`) over the number of entities tagged with it.
+    Under `"*"` it also recommends the single threshold with the best micro F-beta over all labels.
+
+    Returns:
+        Dict[str, Dict[str, float]]: label -> {threshold, precision, recall, f1 (F-beta), gazetteer size, support}.
+    """
+    columns = scores.label_columns()
+    matrix = np.asarray(scores.scores, dtype=np.float32)
+    curves = {label: (matrix[:, j], columns == j) for j, label in enumerate(scores.labels)}
+    # micro average: every (entity, label) pair is a prediction, correct when the label is the entity's tag
+    curves["*"] = (matrix.ravel(), (columns[:, None] == np.arange(len(scores.labels))[None, :]).ravel())
+
+    recommendations = {}
+    for label, (label_scores, positives) in curves.items():
+        thresholds, precision, recall, support = precision_recall_curve(label_scores, positives)
+        if len(thresholds) == 0:
+            continue
+        denominator = beta ** 2 * precision + recall
+        f_beta = np.divide((1 + beta ** 2) * precision * recall, denominator, out=np.zeros_like(precision), where=denominator > 0)
+        best = int(np.argmax(f_beta))
+        recommendations[label] = {
+            "threshold": float(thresholds[best]), "precision": float(precision[best]), "recall": float(recall[best]),
+            "f1": float(f_beta[best]), "size": int(np.count_nonzero(label_scores >= thresholds[best])), "support": support,
+        }
+    return recommendations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recommend similarity thresholds from a cached score matrix.', add_help=False)
+    parser.add_argument('--scores', type=str, help='Score matrix written by make_gazetteer, e.g. datasets/multiconer/multiconer_scores.npz.')
+    parser.add_argument('--beta', type=float, help='Weight of recall against precision in the F-score.', default=1.0)
+    parser.add_argument('--out', type=str, help='JSON file to write the recommendations to.', default=None)
+    sg = parser.parse_args()
+
+    recommendations = tune_thresholds(EntityScores.load(sg.scores), sg.beta)
+    print(f"{'label':<24} {'threshold':>9} {'precision':>9} {'recall':>9} {'f1':>9} {'size':>9} {'support':>9}")
+    for label, values in recommendations.items():
+        print(f"{label:<24} {values['threshold']:>9.4f} {values['precision']:>9.4f} {values['recall']:>9.4f} {values['f1']:>9.4f} {values['size']:>9} {values['support']:>9}")
+    if sg.out:
+        with open(sg.out, 'w', encoding='utf-8') as file:
+            json.dump(recommendations, file, ensure_ascii=False, indent=4)
@@ -0,0 +1,96 @@
+import os
+from typing import Dict, Iterable, TextIO
+
+
+class GazetteerWriter:
+    """
+    Writes the `<label>.txt` files of a gazetteer directory for a whole run.
+
+    Every label keeps one buffered handle on a hidden partial file and the set of its entries, so an entry is written
+    once per label however often it is added. `close()` publishes the final files, each file replaced atomically
+    (temp file plus rename): readers see either the previous or the new version, never a half written one. With
+    `sort` the final files are sorted instead of in order of addition. A run replaces the whole gazetteer: the
+    `<label>.txt` files of an earlier run whose label gets no entry in this one are removed on `close()`, every other
+    `*.txt` of the directory must be listed in `other_files`.
+
+    Usage:
+        with GazetteerWriter(directory_path) as writer:
+            writer.add("PER", "barack obama")
+    """
+
+    def __init__(self, directory_path: str, sort: bool = False, buffer_size: int = 1 << 20, other_files: Iterable[str] = ()):
+        self.directory_path = directory_path
+        self.sort = sort
+        self.other_files = set(other_files)
+        self.buffer_size = buffer_size
+        self._entries: Dict[str, Dict[str, None]] = {}
+        self._handles: Dict[str, TextIO] = {}
+        os.makedirs(directory_path, exist_ok=True)
+
+    def __enter__(self) -> "GazetteerWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the files of the previous run
+            self._discard()
+
+    def _path(self, label: str) -> str:
+        return os.path.join(self.directory_path, f"{label}.txt")
+
+    def _partial_path(self, label: str) -> str:
+        return os.path.join(self.directory_path, f".{label}.txt.partial")
+
+    def add(self, label: str, entry: str) -> bool:
+        """
+        Adds an entry to the gazetteer of `label`. Returns False when the label already has it.
+        """
+        entries = self._entries.setdefault(label, {})
+        if entry in entries:
+            return False
+        entries[entry] = None
+        handle = self._handles.get(label)
+        if handle is None:
+            handle = self._handles[label] = open(self._partial_path(label), 'w', encoding='utf-8', buffering=self.buffer_size)
+        handle.write(entry + '\n')
+        return True
+
+    def add_many(self, label: str, entries: Iterable[str]) -> int:
+        """
+        Adds entries to the gazetteer of `label`. Returns the number of new ones.
+        """
+        return sum(self.add(label, entry) for entry in entries)
+
+    def close(self) -> None:
+        """
+        Publishes the final `<label>.txt` files, removes the partial files and the gazetteers of the labels without
+        entries in this run.
+        """
+        for label, handle in self._handles.items():
+            handle.close()
+            if self.sort:
+                self._publish_sorted(label)
+                os.remove(self._partial_path(label))
+            else:
+                os.replace(self._partial_path(label), self._path(label))
+        self._handles.clear()
+        for filename in os.listdir(self.directory_path):
+            if filename.endswith(".txt") and filename[:-4] not in self._entries and filename not in self.other_files:
+                os.remove(os.path.join(self.directory_path, filename))
+
+    def _publish_sorted(self, label: str) -> None:
+        """
+        Replaces `<label>.txt` with the sorted entries of the label.
+        """
+        tmp_path = self._path(label) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8', buffering=self.buffer_size) as file:
+            file.writelines(f"{entry}\n" for entry in sorted(self._entries[label]))
+        os.replace(tmp_path, self._path(label))
+
+    def _discard(self) -> None:
+        for label, handle in self._handles.items():
+            handle.close()
+            os.remove(self._partial_path(label))
+        self._handles.clear()
@@ -1,10 +1,28 @@
-import sys
-from SPARQLWrapper import SPARQLWrapper, JSON
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import logging
 import os
+import re
+import threading
+import time
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
 from tqdm import tqdm
-import requests
+import wiki_http
+from http_cache import DEFAULT_CACHE_PATH
+from label_set import DEFAULT_MAX_BYTES, LabelSet
+from subclass_closure import SubclassClosure
+from wikidata_dump_index import DEFAULT_INDEX_PATH, WikidataIndex
 
 endpoint_url = "https://query.wikidata.org/sparql"
+# WDQS stops queries after 60 seconds, the answer of a large query can take a while longer to download
+SPARQL_TIMEOUT = 300
+# WDQS allows 5 concurrent queries per client, see https://www.mediawiki.org/wiki/Wikidata_Query_Service/User_Manual#Query_limits
+WDQS_MAX_CONCURRENT = 5
+_query_slots = threading.BoundedSemaphore(WDQS_MAX_CONCURRENT)
+# number of streamed labels de-duplicated at once
+LABEL_BATCH_SIZE = 10000
 
 def get_query(limit: int, topic_id: str, lang:str) -> str:
     query = f"""
@@ -27,60 +45,355 @@ def get_query(limit: int, topic_id: str, lang:str) -> str:
     return query
 
 
-def get_results(endpoint_url, limit, topic_id, lang):
-    query = get_query(limit, topic_id, lang)
-    user_agent = "WDQS-example Python/%s.%s" % (sys.version_info[0], sys.version_info[1])
-    # TODO adjust user agent; see https://w.wiki/CX6
-    sparql = SPARQLWrapper(endpoint_url, agent=user_agent)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    return sparql.query().convert()
+def fetch_labels(tax_id: str, LIMIT: int, LANG: str) -> List[str]:
+    """
+    Returns the lowercased labels of the items under `tax_id`, lowering the limit while the query fails.
+    The answer is streamed as TSV (see `stream_page`) and only the labels are kept, never the whole answer; a complete
+    answer is kept in the response cache.
+    """
+    current_limit = LIMIT
+    while current_limit > 0:
+        try:
+            return [label.lower() for _, label in stream_page(endpoint_url, get_query(current_limit, tax_id, LANG), use_cache=True) if label]
+        except Exception as e:
+            print(f"Error fetching results with limit {current_limit}: {e}")
+            if current_limit <= 500000:
+                current_limit -= 10000  # Decrease limit by 10,000 and retry
+            else:
+                current_limit //= 2
+    logging.error(f"Failed to fetch results for tax_id {tax_id} after several attempts, its gazetteer entries are left out.")
+    return []
 
-def make_gazetteer(taxonomy_file, LIMIT, LANG, gzt_name):
-    # taxonomy_file = "label_taxonomy/multiconer_en/PER.txt"
-    filename_with_extension = os.path.basename(taxonomy_file)
-    tag_name = os.path.splitext(filename_with_extension)[0]
-    itemLabel_set = {}
-    taxonomy_ids = []
+
+def read_taxonomy(taxonomy_file: str) -> Tuple[str, List[str]]:
+    """
+    Returns the tag of a taxonomy file (`label_taxonomy/multiconer_en/PER.txt` -> `PER`) and its QIDs.
+    """
+    tag_name = os.path.splitext(os.path.basename(taxonomy_file))[0]
     with open(taxonomy_file, "r", encoding="utf-8") as reader:
-        lines = reader.readlines()
-        for line in lines:
-            tax_id = line.split()[-1]
-            taxonomy_ids.append(tax_id)
+        taxonomy_ids = [line.split()[-1] for line in reader if line.strip()]
+    return tag_name, taxonomy_ids
+
+
+def write_gazetteer(path: str, labels_per_id: Iterable[List[str]], max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+    """
+    Writes the labels of all QIDs of a tag, each label once, in order of first appearance.
+    The seen labels are kept in a `LabelSet` of at most `max_bytes`, spilled next to the gazetteer beyond that.
+    """
+    with LabelSet(max_bytes, spill_dir=os.path.dirname(path) or None) as itemLabel_set, open(path, "w", encoding="utf-8") as writer:
+        for labels in labels_per_id:
+            writer.writelines(f"{itemLabel}\n" for itemLabel in itemLabel_set.add(labels))
+
+
+def make_gazetteer(taxonomy_file, LIMIT, LANG, gzt_name, max_bytes: int = DEFAULT_MAX_BYTES):
+    # taxonomy_file = "label_taxonomy/multiconer_en/PER.txt"
+    tag_name, taxonomy_ids = read_taxonomy(taxonomy_file)
+    os.makedirs(f"gazetteers/{gzt_name}/", exist_ok=True)
+    write_gazetteer(f"gazetteers/{gzt_name}/{tag_name}.txt",
+                    (fetch_labels(tax_id, LIMIT, LANG) for tax_id in tqdm(taxonomy_ids, desc=f"Creating gzt for {tag_name}")), max_bytes)
+
+
+class _OrderedGazetteer:
+    """
+    The gazetteer of one tag while its QIDs are answered in any order. The labels of a QID go through the tag's
+    `LabelSet` to the file as soon as all the QIDs before it are written, then they are dropped, so only the answers
+    waiting for an earlier QID are held in memory.
+    """
+
+    def __init__(self, path: str, n_ids: int, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.n_ids = n_ids
+        self._label_set = LabelSet(max_bytes, spill_dir=os.path.dirname(path) or None)
+        self._writer = open(path, "w", encoding="utf-8")
+        self._waiting: Dict[int, List[str]] = {}
+        self._next_position = 0
+
+    def add(self, position: int, labels: List[str]) -> bool:
+        """
+        Adds the labels of the QID at `position` of the taxonomy file. Returns True once every QID is written.
+        """
+        self._waiting[position] = labels
+        while self._next_position in self._waiting:
+            labels = self._waiting.pop(self._next_position)
+            for start in range(0, len(labels), LABEL_BATCH_SIZE):
+                self._writer.writelines(f"{itemLabel}\n" for itemLabel in self._label_set.add(labels[start:start + LABEL_BATCH_SIZE]))
+            self._next_position += 1
+        return self.done
+
+    @property
+    def done(self) -> bool:
+        return self._next_position == self.n_ids
+
+    def close(self) -> None:
+        self._writer.close()
+        self._label_set.close()
+
+
+def make_gazetteers_parallel(taxonomy_files: List[str], LIMIT: int, LANG: str, gzt_name: str, workers: int = WDQS_MAX_CONCURRENT,
+                             max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+    """
+    Same gazetteers as `make_gazetteer` for many taxonomy files at once: the QIDs of all files are queried by a pool of
+    `workers` threads, under the shared rate limit of `wiki_http` and at most `WDQS_MAX_CONCURRENT` queries in flight.
+    The labels of a QID are written to the gazetteer of its tag as soon as the QIDs before it are written (see
+    `_OrderedGazetteer`), in the same order as the sequential run.
+
+    Args:
+        taxonomy_files (List[str]): The taxonomy files, e.g. `label_taxonomy/rdrs/*.txt`.
+        LIMIT (int): The maximum number of items per QID.
+        LANG (str): The language of the labels.
+        gzt_name (str): The name of the gazetteer directory inside `gazetteers/`.
+        workers (int): The number of query threads.
+        max_bytes (int): The memory of the de-duplication set of each tag.
+    """
+    os.makedirs(f"gazetteers/{gzt_name}/", exist_ok=True)
+    taxonomies = [read_taxonomy(taxonomy_file) for taxonomy_file in taxonomy_files]
+    timings = []
+
+    def fetch(tag_name: str, position: int, tax_id: str) -> Tuple[str, int, str, List[str], float]:
+        started = time.time()
+        try:
+            tax_labels = fetch_labels(tax_id, LIMIT, LANG)
+        except Exception:
+            # one failed QID must not stop the other queries nor the gazetteers of the other tags
+            logging.exception(f"Failed to fetch the labels of {tag_name} {tax_id}, its gazetteer entries are left out.")
+            tax_labels = []
+        return tag_name, position, tax_id, tax_labels, time.time() - started
+
+    started = time.time()
+    with contextlib.ExitStack() as stack, concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        gazetteers = {}
+        for tag_name, taxonomy_ids in taxonomies:
+            gazetteer = gazetteers[tag_name] = _OrderedGazetteer(f"gazetteers/{gzt_name}/{tag_name}.txt", len(taxonomy_ids), max_bytes)
+            stack.callback(gazetteer.close)
+        futures = [executor.submit(fetch, tag_name, position, tax_id)
+                   for tag_name, taxonomy_ids in taxonomies for position, tax_id in enumerate(taxonomy_ids)]
+        n_futures = len(futures)
+        completed = concurrent.futures.as_completed(futures)
+        # as_completed drops every future it has yielded, so the labels of a written QID are freed
+        del futures
+        for tag_name in [tag_name for tag_name, gazetteer in gazetteers.items() if gazetteer.done]:
+            gazetteers.pop(tag_name).close()
+        for future in tqdm(completed, total=n_futures, desc=f"Creating gzt {gzt_name}"):
+            tag_name, position, tax_id, tax_labels, elapsed = future.result()
+            timings.append((elapsed, tag_name, tax_id, len(tax_labels)))
+            print(f"{tag_name} {tax_id}: {len(tax_labels)} items in {elapsed:.1f}s")
+            if gazetteers[tag_name].add(position, tax_labels):
+                gazetteers.pop(tag_name).close()
+    if timings:
+        elapsed, tag_name, tax_id, count = max(timings)
+        print(f"{len(timings)} queries in {time.time() - started:.1f}s, slowest: {tag_name} {tax_id} ({count} items) in {elapsed:.1f}s")
+
+
+def get_page_query(topic_id: str, lang: str, page_size: int, offset: int) -> str:
+    """
+    One page of the items under `topic_id`: the distinct items are ordered, so that consecutive OFFSETs
+    partition them, and every item of the page is returned with its label in `lang` (unbound when it has none),
+    so a page shorter than `page_size` is the last one.
+    """
+    query = f"""
+    SELECT ?item ?itemLabel
+    WHERE {{
+        {{
+            SELECT DISTINCT ?item WHERE {{
+                ?item p:P31 ?statement0.
+                ?statement0 (ps:P31/(wdt:P279*)) wd:{topic_id}.
+            }}
+            ORDER BY ?item
+            LIMIT {page_size}
+            OFFSET {offset}
+        }}
+        OPTIONAL {{
+            ?item rdfs:label ?itemLabel .
+            FILTER(LANG(?itemLabel) = '{lang}')
+        }}
+    }}
+    """
+    return query
+
+
+_TSV_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+_TSV_ESCAPE_PATTERN = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+
+
+def parse_tsv_term(term: str) -> str:
+    """
+    Returns the value of an RDF term of a SPARQL TSV result: `<iri>`, `"literal"@lang`, `"literal"^^<type>` or a bare number.
+    """
+    if term.startswith('<') and term.endswith('>'):
+        return term[1:-1]
+    if term.startswith('"'):
+        end = term.rfind('"')
+        value = term[1:end]
+        return _TSV_ESCAPE_PATTERN.sub(_unescape, value)
+    return term
+
+
+def _unescape(match: re.Match) -> str:
+    escape = match.group(1)
+    if len(escape) > 1:  # \uXXXX or \UXXXXXXXX
+        return chr(int(escape[1:], 16))
+    return _TSV_ESCAPES.get(escape, escape)
+
+
+def stream_page(endpoint_url: str, query: str, use_cache: bool = False) -> Generator[List[str], None, None]:
+    """
+    Runs a SPARQL query and yields its result rows one at a time (values of the TSV columns), without holding the answer in memory.
+    With `use_cache` a complete answer is stored in the response cache (see `wiki_http.iter_lines`) and later runs read
+    it from there. Harvested pages bypass the cache, the harvest state file takes its role.
+    The query holds one of the `WDQS_MAX_CONCURRENT` slots until its answer is read.
+    """
+    with _query_slots:
+        response = wiki_http.get(endpoint_url, params={"query": query}, headers={"Accept": "text/tab-separated-values"},
+                                 timeout=SPARQL_TIMEOUT, use_cache=use_cache, stream=True)
+        with contextlib.closing(response):
+            response.raise_for_status()
+            lines = wiki_http.iter_lines(response)
+            next(lines, None)  # header: ?item ?itemLabel
+            for line in lines:
+                yield [parse_tsv_term(term) if term else '' for term in line.split('\t')]
+
 
+def harvest_gazetteer(taxonomy_file, LANG, gzt_name, page_size: int = 50000, max_retries: int = 5, max_bytes: int = DEFAULT_MAX_BYTES,
+                      limit: Optional[int] = None):
+    """
+    The gazetteer of a taxonomy file harvested page by page (`get_page_query`) with the rows streamed to the output.
+    Like `make_gazetteer` it takes at most `limit` items per taxonomy QID (all of them when None); as the pages are
+    ordered by item, these are the first items by QID, not the items WDQS happens to return first for one query.
+
+    After every page the output is flushed and its size and the next offset are saved in
+    `gazetteers/{gzt_name}/.{tag}.harvest.json`. A rerun after a failure truncates the output to the last completed page
+    and continues from there. A failing page is retried with half the page size, up to `max_retries` times.
+    Labels are de-duplicated in batches of `LABEL_BATCH_SIZE` by a `LabelSet` of at most `max_bytes`.
+    """
+    tag_name, taxonomy_ids = read_taxonomy(taxonomy_file)
     os.makedirs(f"gazetteers/{gzt_name}/", exist_ok=True)
-    with open(f"gazetteers/{gzt_name}/{tag_name}.txt", "w", encoding="utf-8") as writer:
-        for tax_id in tqdm(taxonomy_ids, desc=f"Creating gzt for {tag_name}"):
-            current_limit = LIMIT
-            while current_limit > 0:
-                try:
-                    results = get_results(endpoint_url, current_limit, tax_id, LANG)
-                    break  # If successful, break out of the while loop
-                except Exception as e:
-                    print(f"Error fetching results with limit {current_limit}: {e}")
-                    if current_limit <= 500000:
-                        current_limit -= 10000  # Decrease limit by 10,000 and retry
-                    else:
-                        current_limit /= 2
-                    if current_limit <= 0:
-                        print(f"Failed to fetch results for tax_id {tax_id} after several attempts.")
-                        continue  # Skip to the next tax_id if limit becomes zero or negative
-
-            for result in results["results"]["bindings"]:
-                itemLabel = result['itemLabel']['value'].lower()
-                if itemLabel not in itemLabel_set:
-                    writer.write(f"{itemLabel}\n")
-                    itemLabel_set[itemLabel] = None
+    output_path = f"gazetteers/{gzt_name}/{tag_name}.txt"
+    state_path = f"gazetteers/{gzt_name}/.{tag_name}.harvest.json"
+    state = {"taxonomy_ids": taxonomy_ids, "limit": limit, "done": [], "current": None, "offset": 0, "bytes": 0}
+    if os.path.isfile(state_path) and os.path.isfile(output_path):
+        with open(state_path, "r", encoding="utf-8") as reader:
+            saved_state = json.load(reader)
+        if saved_state.get("taxonomy_ids") == taxonomy_ids and saved_state.get("limit") == limit:
+            state = saved_state
+    with open(output_path, "a+b") as writer:
+        # drop the rows of a page that was not completed, and rebuild the de-duplication set from the completed ones
+        writer.truncate(state["bytes"])
+        itemLabel_set = _read_labels(output_path, max_bytes)
+
+        try:
+            for tax_id in tqdm(taxonomy_ids, desc=f"Harvesting gzt for {tag_name}"):
+                if tax_id in state["done"]:
+                    continue
+                offset = state["offset"] if state["current"] == tax_id else 0
+                current_page_size = page_size
+                failures = 0
+                while True:
+                    started = time.time()
+                    n_rows = 0
+                    batch = []
+                    requested = current_page_size if limit is None else min(current_page_size, limit - offset)
+                    try:
+                        for item, label in stream_page(endpoint_url, get_page_query(tax_id, LANG, requested, offset)):
+                            n_rows += 1
+                            if label:
+                                batch.append(label.lower())
+                            if len(batch) >= LABEL_BATCH_SIZE:
+                                _write_new_labels(writer, itemLabel_set, batch)
+                                batch = []
+                        _write_new_labels(writer, itemLabel_set, batch)
+                    except Exception as e:
+                        # roll back the partial page
+                        writer.flush()
+                        writer.truncate(state["bytes"])
+                        itemLabel_set.close()
+                        itemLabel_set = _read_labels(output_path, max_bytes)
+                        failures += 1
+                        print(f"Error fetching page at offset {offset} of {tax_id} with page size {requested}: {e}")
+                        if failures > max_retries:
+                            raise
+                        current_page_size = max(current_page_size // 2, 1000)
+                        continue
+                    writer.flush()
+                    os.fsync(writer.fileno())
+                    offset += n_rows
+                    last_page = n_rows < requested or (limit is not None and offset >= limit)
+                    state.update({"current": None if last_page else tax_id, "offset": 0 if last_page else offset, "bytes": os.path.getsize(output_path)})
+                    if last_page:
+                        state["done"].append(tax_id)
+                    _write_state(state_path, state)
+                    print(f"{tax_id}: {n_rows} rows at offset {offset - n_rows} in {time.time() - started:.1f}s")
+                    if last_page:
+                        break
+        finally:
+            itemLabel_set.close()
+
+
+def _write_new_labels(writer, itemLabel_set: LabelSet, labels: List[str]) -> None:
+    writer.write("".join(f"{itemLabel}\n" for itemLabel in itemLabel_set.add(labels)).encode("utf-8"))
+
+
+def _read_labels(path: str, max_bytes: int = DEFAULT_MAX_BYTES) -> LabelSet:
+    """
+    Returns the labels already written to a gazetteer, as the de-duplication set of a resumed harvest.
+    """
+    itemLabel_set = LabelSet(max_bytes, spill_dir=os.path.dirname(path) or None)
+    with open(path, "r", encoding="utf-8") as reader:
+        while True:
+            lines = reader.readlines(LABEL_BATCH_SIZE * 32)
+            if not lines:
+                return itemLabel_set
+            itemLabel_set.add([line.rstrip("\n") for line in lines])
+
+
+def _write_state(state_path: str, state: Dict) -> None:
+    with open(state_path + ".tmp", "w", encoding="utf-8") as writer:
+        json.dump(state, writer)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def make_gazetteer_offline(taxonomy_file, LANG, gzt_name, closure: SubclassClosure, index: WikidataIndex, max_bytes: int = DEFAULT_MAX_BYTES):
+    """
+    Same gazetteer as `make_gazetteer`, answered from the subclass closure and the offline Wikidata index
+    instead of the SPARQL endpoint: the items whose P31 is under each taxonomy QID, with their label in `LANG`.
+    """
+    tag_name, taxonomy_ids = read_taxonomy(taxonomy_file)
+    os.makedirs(f"gazetteers/{gzt_name}/", exist_ok=True)
+    labels_per_id = ([label.lower() for label in index.get_labels([f"Q{number}" for number in closure.instance_numbers(tax_id)], LANG).values()]
+                     for tax_id in tqdm(taxonomy_ids, desc=f"Creating gzt for {tag_name}"))
+    write_gazetteer(f"gazetteers/{gzt_name}/{tag_name}.txt", labels_per_id, max_bytes)
+
 
 if __name__ == "__main__":
-    taxonomy_directory = 'label_taxonomy/rdrs/'  # Specify the directory path
-    gzt_name = "gzt_rdrs_all"
-    LIMIT = 1000000
-    LANG = "ru"
-
-    for filename in os.listdir(taxonomy_directory):
-        if filename.endswith(".txt"):
-            filepath = os.path.join(taxonomy_directory, filename)
+    parser = argparse.ArgumentParser(description='Create gazetteers from the label taxonomies.', add_help=False)
+    parser.add_argument('--taxonomy_dir', type=str, help='Directory of the taxonomy files.', default='label_taxonomy/rdrs/')
+    parser.add_argument('--gzt_name', type=str, help='Name of the gazetteer directory inside gazetteers/.', default="gzt_rdrs_all")
+    parser.add_argument('--limit', type=int, help='Maximum number of items per taxonomy QID.', default=1000000)
+    parser.add_argument('--lang', type=str, help='Language of the item labels.', default="ru")
+    parser.add_argument('--harvest', action='store_true', help='Harvest page by page with resume instead of one query per QID.')
+    parser.add_argument('--page_size', type=int, help='Number of items per page in --harvest mode.', default=50000)
+    parser.add_argument('--workers', type=int, help='Number of taxonomy queries run in parallel (WDQS allows at most 5 at once).', default=WDQS_MAX_CONCURRENT)
+    parser.add_argument('--rate', type=float, help='Maximum number of queries started per second, over all workers.', default=1)
+    parser.add_argument('--dedup_max_mb', type=int, help='Memory of the label de-duplication set of a gazetteer in MB, spilled to disk beyond it.', default=DEFAULT_MAX_BYTES // 1024 ** 2)
+    parser.add_argument('--closure', type=str, help='Subclass closure index, answers offline instead of querying WDQS.', default=None)
+    parser.add_argument('--wikidata_index', type=str, help='Offline Wikidata index used with --closure.', default=DEFAULT_INDEX_PATH)
+    sg = parser.parse_args()
+    taxonomy_directory = sg.taxonomy_dir
+    gzt_name = sg.gzt_name
+    LIMIT = sg.limit
+    LANG = sg.lang
+    max_bytes = sg.dedup_max_mb * 1024 ** 2
+    wiki_http.configure(rate=sg.rate, pool_size=sg.workers, cache_path=DEFAULT_CACHE_PATH)
+    taxonomy_files = [os.path.join(taxonomy_directory, filename) for filename in sorted(os.listdir(taxonomy_directory)) if filename.endswith(".txt")]
+
+    if sg.closure:
+        closure = SubclassClosure.load(sg.closure)
+        index = WikidataIndex(sg.wikidata_index)
+        for filepath in taxonomy_files:
             print(f"Processing {filepath}")
-            make_gazetteer(filepath, LIMIT, LANG, gzt_name)
+            make_gazetteer_offline(filepath, LANG, gzt_name, closure, index, max_bytes)
+    elif sg.harvest:
+        # every taxonomy file has its own output and harvest state, so the files are harvested in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(sg.workers, 1)) as executor:
+            list(executor.map(lambda filepath: harvest_gazetteer(filepath, LANG, gzt_name, sg.page_size, max_bytes=max_bytes, limit=LIMIT), taxonomy_files))
+    else:
+        make_gazetteers_parallel(taxonomy_files, LIMIT, LANG, gzt_name, sg.workers, max_bytes)
     
\ No newline at end of file
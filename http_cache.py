@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+DEFAULT_CACHE_PATH = "cache/wikidata_http.sqlite"
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+# request parameters that do not change the answer and are left out of the cache key
+IGNORED_PARAMS = {"maxlag"}
+
+
+def make_key(url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None) -> str:
+    """
+    Returns the cache key of a GET request: a SHA-256 of the URL, the normalized parameters
+    (sorted, values converted to strings, parameters in `IGNORED_PARAMS` dropped) and the `Accept` header.
+    """
+    normalized = sorted((str(name), str(value)) for name, value in (params or {}).items() if name not in IGNORED_PARAMS)
+    accept = (headers or {}).get("Accept", "")
+    return hashlib.sha256(json.dumps([url, normalized, accept], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of HTTP response bodies in SQLite.
+
+    The database runs in WAL mode, so several threads and processes on one machine can read and write it at once.
+    Entries older than `ttl` seconds are treated as misses and removed by `evict()`, which also removes the least
+    recently used entries while the stored bodies take more than `max_bytes`.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl: float = DEFAULT_TTL, max_bytes: int = DEFAULT_MAX_BYTES, evict_every: int = 1000):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._puts = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, url TEXT, status INTEGER, content_type TEXT, body BLOB, "
+                "size INTEGER, created REAL, accessed REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.evict()
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread, sqlite3 connections must not be shared between threads.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[int, str, bytes]]:
+        """
+        Returns (status, content type, body) of a cached response, or None when it is missing or expired.
+        """
+        conn = self._connection()
+        row = conn.execute("SELECT status, content_type, body, created, accessed FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        status, content_type, body, created, accessed = row
+        now = time.time()
+        if now - created > self.ttl:
+            return None
+        # the access time only drives eviction, so it is refreshed at most once an hour to keep reads cheap
+        if now - accessed > 3600:
+            with conn:
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return status, content_type, body
+
+    def put(self, key: str, url: str, status: int, content_type: str, body: bytes) -> None:
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, url, status, content_type, body, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, status, content_type, body, len(body), now, now)
+            )
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes expired entries, then the least recently used ones until the bodies fit in `max_bytes`.
+        """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            cutoff = None
+            for accessed, size in conn.execute("SELECT accessed, size FROM responses ORDER BY accessed"):
+                total -= size
+                cutoff = accessed
+                if total <= self.max_bytes:
+                    break
+            conn.execute("DELETE FROM responses WHERE accessed <= ?", (cutoff,))
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+from typing import Iterable, List, Optional
+
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+_EMPTY = np.uint64(0)
+_INITIAL_CAPACITY = 1 << 16
+
+
+def hash_labels(labels: Iterable[str]) -> np.ndarray:
+    """
+    Returns the 64-bit BLAKE2b hashes of the labels. 0 marks an empty slot of the hash table, so it is mapped to 1.
+    """
+    hashes = np.fromiter((int.from_bytes(hashlib.blake2b(label.encode('utf-8'), digest_size=8).digest(), 'little') for label in labels),
+                         dtype=np.uint64)
+    hashes[hashes == _EMPTY] = 1
+    return hashes
+
+
+def _merge_runs(a: np.ndarray, b: np.ndarray, path: str, chunk_size: int) -> None:
+    """
+    Merges two sorted runs into the file `path`, reading at most `chunk_size` hashes of each run at a time.
+    """
+    i = j = 0
+    with open(path, 'wb') as writer:
+        while i < len(a) and j < len(b):
+            chunk_a, chunk_b = a[i:i + chunk_size], b[j:j + chunk_size]
+            bound = min(chunk_a[-1], chunk_b[-1])
+            n_a = int(np.searchsorted(chunk_a, bound, side='right'))
+            n_b = int(np.searchsorted(chunk_b, bound, side='right'))
+            np.sort(np.concatenate([chunk_a[:n_a], chunk_b[:n_b]])).tofile(writer)
+            i += n_a
+            j += n_b
+        for run, start in ((a, i), (b, j)):
+            for offset in range(start, len(run), chunk_size):
+                np.asarray(run[offset:offset + chunk_size]).tofile(writer)
+
+
+class LabelSet:
+    """
+    Set of seen labels with bounded memory, for de-duplicating gazetteers of millions of labels.
+
+    Labels are kept as 64-bit hashes in a NumPy open-addressing table (linear probing, at most half full).
+    When the table would outgrow `max_bytes` its hashes are sorted and spilled to a run file in `spill_dir`, runs of
+    similar size are merged like an external sort, and lookups binary search the memory-mapped runs.
+    Two labels share a hash with a probability of about n^2 / 2^65 (below 1e-5 for 10 million labels).
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, spill_dir: Optional[str] = None):
+        self.max_capacity = max(_INITIAL_CAPACITY, 1 << (max(max_bytes // 8, 1).bit_length() - 1))
+        self._spill_dir = spill_dir
+        self._run_dir: Optional[str] = None
+        self._runs: List[np.ndarray] = []
+        self._run_paths: List[str] = []
+        self._n_spilled = 0
+        self._table = np.zeros(min(_INITIAL_CAPACITY, self.max_capacity), dtype=np.uint64)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count + sum(len(run) for run in self._runs)
+
+    def __enter__(self) -> "LabelSet":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Removes the spilled runs.
+        """
+        self._runs = []
+        self._run_paths = []
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+
+    def add(self, labels: List[str]) -> List[str]:
+        """
+        Adds a batch of labels to the set.
+
+        Returns:
+            List[str]: The labels that were not in the set before, in order, each once.
+        """
+        if not labels:
+            return []
+        hashes = hash_labels(labels)
+        _, first = np.unique(hashes, return_index=True)
+        first.sort()
+        candidates = hashes[first]
+        is_new = np.zeros(len(candidates), dtype=bool)
+        # insert in pieces that fit in half of the largest table; a spill happens before a piece is looked up
+        piece_size = self.max_capacity // 4
+        for start in range(0, len(candidates), piece_size):
+            piece = candidates[start:start + piece_size]
+            self._reserve(len(piece))
+            positions = np.flatnonzero(~self._in_runs(piece))
+            is_new[positions + start] = self._insert(piece[positions])
+        return [labels[position] for position in first[is_new]]
+
+    def _in_runs(self, hashes: np.ndarray) -> np.ndarray:
+        present = np.zeros(len(hashes), dtype=bool)
+        for run in self._runs:
+            positions = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+            present |= run[positions] == hashes
+        return present
+
+    def _reserve(self, n: int) -> None:
+        """
+        Makes room for `n` more hashes: grows the table while it fits in memory, spills it otherwise.
+        """
+        while 2 * (self._count + n) > len(self._table):
+            if len(self._table) < self.max_capacity:
+                self._resize(2 * len(self._table))
+            else:
+                self._spill()
+                return
+
+    def _resize(self, capacity: int) -> None:
+        hashes = self._table[self._table != _EMPTY]
+        self._table = np.zeros(capacity, dtype=np.uint64)
+        self._count = 0
+        self._insert(hashes)
+
+    def _insert(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Inserts distinct hashes with vectorized linear probing; returns which of them were not in the table.
+        """
+        mask = np.uint64(len(self._table) - 1)
+        new = np.zeros(len(hashes), dtype=bool)
+        pending = np.arange(len(hashes))
+        slots = (hashes & mask).astype(np.int64)
+        while len(pending):
+            current = self._table[slots]
+            found = current == hashes[pending]
+            empty = np.flatnonzero(current == _EMPTY)
+            # several hashes may probe the same empty slot, the first one takes it
+            _, first = np.unique(slots[empty], return_index=True)
+            winners = empty[first]
+            self._table[slots[winners]] = hashes[pending[winners]]
+            new[pending[winners]] = True
+            self._count += len(winners)
+            done = found
+            done[winners] = True
+            # losers retry the same slot (now taken by a different hash), the others move on
+            step = (current != _EMPTY).astype(np.int64)
+            pending, slots = pending[~done], (slots[~done] + step[~done]) & int(mask)
+        return new
+
+    def _spill(self) -> None:
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix="labelset-", dir=self._spill_dir)
+        run = np.sort(self._table[self._table != _EMPTY])
+        path = os.path.join(self._run_dir, f"run{self._n_spilled}.u64")
+        self._n_spilled += 1
+        run.tofile(path)
+        self._runs.append(np.memmap(path, dtype=np.uint64, mode='r', shape=(len(run),)))
+        self._run_paths.append(path)
+        self._table = np.zeros(len(self._table), dtype=np.uint64)
+        self._count = 0
+        # keep a logarithmic number of runs: merge the newest two while the older is not larger
+        while len(self._runs) > 1 and len(self._runs[-2]) <= len(self._runs[-1]):
+            path = os.path.join(self._run_dir, f"run{self._n_spilled}.u64")
+            self._n_spilled += 1
+            _merge_runs(self._runs[-2], self._runs[-1], path, chunk_size=max(self.max_capacity // 8, 1))
+            size = len(self._runs[-2]) + len(self._runs[-1])
+            for old_path in self._run_paths[-2:]:
+                os.remove(old_path)
+            self._runs[-2:] = [np.memmap(path, dtype=np.uint64, mode='r', shape=(size,))]
+            self._run_paths[-2:] = [path]
@@ -2,10 +2,20 @@ from search_wiki_data import *
 from datasets.process_multiconer import _is_divider
 import spacy
 import os
-from typing import List, Dict
+from typing import List, Dict, Generator, Optional, Set, TextIO, Tuple, Union
+import numpy as np
 from spacy.tokens import Doc
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import wiki_http
 from utils import parse_args
+from similarity import LabelSimilarityEngine
+from ner_store import SHARD_SCHEME, NERStore, Shard, entity_shard, normalize_query, open_ner_store, parse_shard, read_results_log, store_path_for, write_ner_store
+from entity_scores import EntityScores, load_cached_scores, merge_partial_gazetteers, parse_thresholds, score_entities, scores_fingerprint
+from qid_labels import QIDLabelIndex, build_qid_label_index, find_taxonomy_directory, index_fingerprint, match_labels
+from subclass_closure import SubclassClosure
+from topic_vectors import TopicVectorStore, embed_topics, get_model_name, resolve_model
 from tqdm import tqdm
 import json
 import re
@@ -35,74 +45,47 @@ def get_label_synonyms2vecs(model: spacy.Language, directory_path: str) -> Dict[
             file_path = os.path.join(directory_path, filename)
             with open(file_path, 'r', encoding='utf-8') as file:
                 lines = [line.strip() for line in file.readlines()]
-                syn2vec_list = [model(line) for line in lines]
+                syn2vec_list = list(model.pipe(lines))
                 files_dict[file_key] = syn2vec_list
     return files_dict
 
 
-def append_word_to_txtfile(word: str, path_to_file: str) -> None:
+def plan_entity_queries(path_to_train_data: str) -> Tuple[Dict[str, List[str]], Dict[str, Dict]]:
     """
-    Appends a word to a text file. If the file does not exist, it creates the file.
+    Streams a processed dataset once and collects its distinct entities before anything is searched.
 
     Args:
-        word (str): The word to append to the file.
-        path_to_file (str): The path to the text file.
+        path_to_train_data (str): The path to the processed dataset file.
+
+    Returns:
+        Tuple[Dict[str, List[str]], Dict[str, Dict]]: The docs_dict (doc id -> entities of the doc) and the entity index
+            (entity -> {'tag': tag of its first occurrence, 'doc_ids': ordered set of the doc ids it occurs in}),
+            both in corpus order.
     """
-    with open(path_to_file, 'a', encoding='utf-8') as file:
-        file.write(word + '\n')
+    docs_dict = {}
+    entity_index = {}
+    with open(path_to_train_data, 'r', encoding='utf-8') as fin:
+        total_lines = sum(1 for _ in fin)
+        fin.seek(0)
+        for line in tqdm(fin, desc=f"Planning searches for {os.path.basename(path_to_train_data)}", total=total_lines):
+            line = line.strip().replace('\u200d', '').replace('\u200c', '').replace('\u200b', '')
+            if _is_divider(line):
+                continue
+            if line.startswith('# id'):
+                doc_id = line.split()[-1]
+                continue
 
+            tag = line.split()[-1]
+            entity = ' '.join(line.split()[:-1])
 
-def add_entity_to_gazetteer(model: spacy.Language, entity: str, true_tag: str, topics: Dict[str, str], label_doc_dict: Dict[str, List[Doc]], threshold: float, directory_path: str) -> bool:
-    """
-    Compares each topic of the entity to each doc from the list of label, take the maximum similarity,
-    if the maximum similarity is greater than the threshold, add the entity to the corresponding gazetteer
-    """
-    # dictionary checks if the entity is added to which label, to avoid adding the same entity to 1 gazetteer
-    added_labels = {label: False for label in label_doc_dict.keys()}
-    # print(f"Entity \"{entity}\" is instance of topics: {topics}")
-    # print()
-
-    # to check if this entity is added to true tag gazetteer, true tag is taken from official data (training data)
-    entity_added_to_true_tag_gazetteer = False
-
-    
-
-    for label, doc_list in label_doc_dict.items():
-        for topic, topic_description in topics.items():
-            # if the entity is already added to this label because similarity of topic to 1 of the doc
-            # is greater than thershold, then dont bother considering other topics.
-            if added_labels[label]:
-                break
-
-            max_similarity = float("-inf")
-            most_related_doc = None
-            
-            # convert the topic to spacy doc
-            topic_doc = model(topic)
-            if topic_doc.has_vector and len(topic_doc) > 0:
-                for doc in doc_list:
-                    if doc.has_vector and len(doc) > 0:
-                        similarity = topic_doc.similarity(doc)
-                        if similarity > max_similarity:
-                            max_similarity = similarity
-                            most_related_doc = doc
-                        if max_similarity == 1:
-                            break
-
-            # add this entity to gazetteer <label>.txt
-            if not added_labels[label] and max_similarity >= threshold:
-                # Construct the path to the gazetteer file
-                path_to_file = os.path.join(directory_path, f"{label}.txt")
-                append_word_to_txtfile(entity, path_to_file)
-                added_labels[label] = True
-                if label == true_tag:
-                    entity_added_to_true_tag_gazetteer = True
-                # print(f"Added \'{entity}\' in term of \'{topic}\' to {label} because it's sim to topic \'{most_related_doc}\' with val {max_similarity:.2f}")
-                # print()
-    return entity_added_to_true_tag_gazetteer
-
-
-def dataset2NERdict(path_to_train_data: str, limit: int, lang: str) -> None:
+            docs_dict.setdefault(doc_id, [])
+            docs_dict[doc_id].append(entity)
+            entity_index.setdefault(entity, {'tag': tag, 'doc_ids': {}})['doc_ids'][doc_id] = None
+    return docs_dict, entity_index
+
+
+def dataset2NERdict(path_to_train_data: str, limit: int, lang: str, workers: int = 1, search_backend: str = DEFAULT_SEARCH_BACKEND, wikidata_index: str = DEFAULT_INDEX_PATH,
+                    shard: Optional[Shard] = None) -> None:
     """
     Process a training dataset and return a dictionary containing the results.
     results = {
@@ -111,13 +94,30 @@ def dataset2NERdict(path_to_train_data: str, limit: int, lang: str) -> None:
             'wiki_topics': {topic : wikidata_code}
         }
     }
-    It creates 2 json files: `{dataset_name}_ners_dict.json` and `{dataset_name}_docs_dict.json`
-    in directory `datasets/{dataset_name}/`
+    It creates the NER store `{dataset_name}_ners.sqlite` (see `ner_store.NERStore`), holding both the results
+    and the entities of every document, in directory `datasets/{dataset_name}/`
+
+    The dataset is planned first (see `plan_entity_queries`), then every distinct normalized entity
+    (see `ner_store.normalize_query`) is searched exactly once. Searches run in a pool of `workers` threads sharing one session,
+    the request rate is limited by the token bucket in `wiki_http` (see `wiki_http.configure`). Their results are
+    applied in corpus order, so the output does not depend on the number of workers.
+
+    Every entity is appended to the log `{dataset_name}_ners_log.jsonl` as soon as its search completes.
+    A restarted run skips the searches of the entities already in the log, and the store is
+    written once at the end. A failed search is not logged: its entities are stored without topics
+    and the next run searches them again.
+
+    With a shard `i/n` only the entities of the shard are searched (see `ner_store.entity_shard`), into the store
+    `{dataset_name}_ners.shard{i}of{n}.sqlite` and the log `{dataset_name}_ners_log.shard{i}of{n}.jsonl`.
 
     Args:
         path_to_train_data (str): The path to the training dataset file.
         limit (int): The limit value for the number of topics to retrieve.
         lang (str): The language for the search.
+        workers (int): The number of concurrent Wikidata searches.
+        search_backend (str): The name of the search backend, see `search_wiki_data.SEARCH_BACKENDS`.
+        wikidata_index (str): The offline index used by the "offline" search backend.
+        shard (Shard, optional): Only search the entities of shard `i` of `n`.
 
     Returns:
         results (Dict[str, Dict]): A dictionary containing the results of the dataset processing.
@@ -125,154 +125,356 @@ def dataset2NERdict(path_to_train_data: str, limit: int, lang: str) -> None:
             'wiki_topics', and 'tag' for each entity.
     """
     try:
-        with open(path_to_train_data, 'r', encoding='utf-8') as fin:
-            results = {}
-            docs_dict = {}
-            sleep_time = 300
-            if not os.path.isfile(path_to_train_data):
-                raise FileNotFoundError(f"The specified training data file was not found: {path_to_train_data}")
-            name_dataset = os.path.basename(path_to_train_data)
-
-            output_dir = f"datasets/{name_dataset}/"
-            os.makedirs(output_dir, exist_ok=True)
-            results_file_path = os.path.join(output_dir, f"{name_dataset}_ners_dict.json")
-            docs_dict_file_path = os.path.join(output_dir, f"{name_dataset}_docs_dict.json")
-
-            #lines = [line.strip().replace('\u200d', '').replace('\u200c', '').replace('\u200b', '') for line in fin if not _is_divider(line)]
-            
-            entity_counter = 0
-            total_lines = sum(1 for _ in fin)
-            fin.seek(0)
-            for line in tqdm(fin, desc=f"Creating NER dict for dataset {name_dataset}", total=total_lines):
-                line = line.strip().replace('\u200d', '').replace('\u200c', '').replace('\u200b', '')
-                if _is_divider(line):
-                    continue
-                if line.startswith('# id'):
-                    doc_id = line.split()[-1]
-                    continue
-                entity_counter += 1
-
-                tag = line.split()[-1]
-                entity = ' '.join(line.split()[:-1])
-
-                docs_dict.setdefault(doc_id, [])
-                docs_dict[doc_id].append(entity)
-
-                if (entity not in results) or (doc_id not in results[entity]['txt_id_list']):
-                    wiki_topics = get_topics_from_wkdt_search_tool(url, api_url, entity, lang, limit)
-                    results.setdefault(entity, {'txt_id_list': [], 'wiki_topics': wiki_topics, 'tag': tag})
-                    results[entity]['txt_id_list'].append(doc_id)
-                    if entity_counter % 1000 == 0:
-                        print(f"Sleep for {sleep_time}!\n")
-                        time.sleep(sleep_time)
-                # write results to file every 100 entities to advoid data loss in case the program crashed
-                if entity_counter % 100 == 0:
-                    _write_results_to_file(results_file_path, docs_dict_file_path, results, docs_dict)
-            if entity_counter % 100 != 0:  # This check ensures we only write if there's data that hasn't been written yet
-                _write_results_to_file(results_file_path, docs_dict_file_path, results, docs_dict)
+        if not os.path.isfile(path_to_train_data):
+            raise FileNotFoundError(f"The specified training data file was not found: {path_to_train_data}")
+        name_dataset = os.path.basename(path_to_train_data)
+
+        output_dir = f"datasets/{name_dataset}/"
+        os.makedirs(output_dir, exist_ok=True)
+        store_path = store_path_for(output_dir, name_dataset, shard)
+        shard_suffix = f".shard{shard[0]}of{shard[1]}" if shard is not None else ""
+        results_log_path = os.path.join(output_dir, f"{name_dataset}_ners_log{shard_suffix}.jsonl")
+
+        docs_dict, entity_index = plan_entity_queries(path_to_train_data)
+        # row ids of the entities in the store, from 1 in corpus order whatever the shard
+        entity_ids = [row_id for row_id, entity in enumerate(entity_index, start=1) if shard is None or entity_shard(entity, shard[1]) == shard[0]]
+        entities = list(entity_index.keys())
+        if shard is not None:
+            entities = [entities[row_id - 1] for row_id in entity_ids]
+        # the surface form searched for every normalized entity, and the index into `queries` of the search of each
+        # entity; queries are numbered in corpus order
+        query_ids = {}
+        queries = []
+        entity_query_ids = []
+        for entity in entities:
+            query_id = query_ids.setdefault(normalize_query(entity), len(queries))
+            if query_id == len(queries):
+                queries.append(entity)
+            entity_query_ids.append(query_id)
+
+        # resume: the topics of every search whose entity is already in the log
+        logged = {}
+        if os.path.isfile(results_log_path):
+            logged = dict(read_results_log(results_log_path))
+            _terminate_last_line(results_log_path)
+        topics_by_query = {}
+        for entity, query_id in zip(entities, entity_query_ids):
+            if entity in logged:
+                topics_by_query.setdefault(query_id, logged[entity]['wiki_topics'])
+        pending = [(query_id, query) for query_id, query in enumerate(queries) if query_id not in topics_by_query]
+        print(f"{len(entities)} distinct entities, {len(queries)} distinct searches, {len(pending)} left to run")
+
+        search = functools.partial(_search_topics, limit=limit, lang=lang, backend=get_search_backend(search_backend, wikidata_index))
+        with ThreadPoolExecutor(max_workers=workers) as executor, open(results_log_path, 'a', encoding='utf-8') as log:
+            failed = set()
+            next_entity = _log_completed_entities(log, entities, entity_query_ids, entity_index, topics_by_query, logged, failed, 0)
+            futures = [(query_id, executor.submit(search, query)) for query_id, query in pending]
+            for query_id, future in tqdm(futures, desc=f"Creating NER dict for dataset {name_dataset}", total=len(pending)):
+                try:
+                    topics_by_query[query_id] = future.result()
+                except Exception as e:
+                    # not logged, so the next run searches it again
+                    logging.error(f"Search for \"{queries[query_id]}\" failed: {e}")
+                    failed.add(query_id)
+                next_entity = _log_completed_entities(log, entities, entity_query_ids, entity_index, topics_by_query, logged, failed, next_entity)
+        if failed:
+            print(f"{len(failed)} searches failed and are stored without topics, run again to retry them")
+
+        # compaction: the store read by make_gazetteer, written once
+        results = ((entity, _make_result(entity_index[entity], topics_by_query.get(query_id, {}))) for entity, query_id in zip(entities, entity_query_ids))
+        write_ner_store(store_path, results, docs_dict.items(), entity_ids=entity_ids)
     except FileNotFoundError as e:
         logging.exception("File not found: %s", e)
     except Exception as e:
         logging.exception("Unexpected error: %s", e)
 
 
-def _write_results_to_file(results_file_path: str, docs_dict_file_path: str, results: Dict, docs_dict: Dict) -> None:
+def _make_result(entity_info: Dict, wiki_topics: Dict[str, str]) -> Dict:
     """
-    Write the results and docs_dict dictionaries to the corresponding JSON files.
+    Builds the ners_dict value of an entity from its entry in the entity index and its topics.
+    """
+    return {'txt_id_list': list(entity_info['doc_ids']), 'wiki_topics': wiki_topics, 'tag': entity_info['tag']}
 
-    Args:
-        results_file_path (str): The file path for the results JSON file.
-        docs_dict_file_path (str): The file path for the docs_dict JSON file.
-        results (Dict): The results dictionary.
-        docs_dict (Dict): The docs_dict dictionary.
 
-    Returns:
-        None
+def _log_completed_entities(log: TextIO, entities: List[str], entity_query_ids: List[int], entity_index: Dict[str, Dict], topics_by_query: Dict[int, Dict[str, str]], logged: Dict[str, Dict],
+                            failed: Set[int], next_entity: int) -> int:
+    """
+    Appends to the results log every entity from `next_entity` on whose search is complete, in corpus order,
+    skipping the ones logged by a previous run and the ones whose search failed. Returns the index of the first
+    entity that is still waiting.
     """
-    with open(results_file_path, 'w', encoding='utf-8') as f, open(docs_dict_file_path, 'w', encoding='utf-8') as f_docs:
-        json.dump(results, f, ensure_ascii=False, indent=4)
-        json.dump(docs_dict, f_docs, ensure_ascii=False, indent=4)
+    while next_entity < len(entities) and (entity_query_ids[next_entity] in topics_by_query or entity_query_ids[next_entity] in failed):
+        entity = entities[next_entity]
+        if entity not in logged and entity_query_ids[next_entity] not in failed:
+            record = _make_result(entity_index[entity], topics_by_query[entity_query_ids[next_entity]])
+            log.write(json.dumps({'entity': entity, **record}, ensure_ascii=False) + '\n')
+            log.flush()
+        next_entity += 1
+    return next_entity
 
 
-def make_gazetteer(model: spacy.language.Language, path_to_train_data: str, threshold: float, limit: int, lang: str) -> None:
+def _terminate_last_line(results_log_path: str) -> None:
     """
-    Creates a gazetteer by extracting topics from a given dataset and adding entities to corresponding gazetteer files.
+    Ends a line cut short by a crash (skipped by `read_results_log`, its entity is searched again),
+    so that the next appended entity starts on a line of its own.
+    """
+    with open(results_log_path, 'rb+') as log:
+        if log.seek(0, os.SEEK_END) == 0:
+            return
+        log.seek(-1, os.SEEK_END)
+        if log.read(1) != b'\n':
+            log.write(b'\n')
 
-    Args:
-        model (spacy.language.Language): A pre-trained spaCy model.
-        path_to_train_data (str): The path to the dataset file. !!!Caution: name of dataset file need to be the same with the label_synonyms file
-        threshold (float): The similarity threshold for adding entities to the gazetteer.
-        limit (int): The maximum number of topics to extract for each entity.
-        lang (str): The language of the dataset.
 
-    Returns:
-        None. The function creates gazetteer files in the specified directory.
+def _search_topics(query: str, limit: int, lang: str, backend: SearchBackend) -> Dict[str, str]:
+    """
+    Searches Wikidata for an entity and returns its topics.
+    """
+    return get_topics_from_wkdt_search_tool(url, api_url, query, lang, limit, backend, raise_errors=True)
+
+
+def _dataset_files(path_to_train_data: str) -> Tuple[str, str, str]:
+    """
+    Returns the NER store, the label synonyms directory and the score cache of a dataset (or fold) file.
     """
     # Extract the name of the dataset from the path
     name_dataset = os.path.basename(path_to_train_data)
     name_dataset_without_digit = re.sub(r'\d+', '', name_dataset)
-
-    with open(os.path.join(f"datasets/{name_dataset_without_digit}", f"{name_dataset_without_digit}_ners_dict.json"), 'r', encoding='utf-8') as ners_file:
-        ners_dict = json.load(ners_file)
-    
-    with open(os.path.join(f"datasets/{name_dataset_without_digit}", f"{name_dataset_without_digit}_docs_dict.json"), 'r', encoding='utf-8') as docs_file:
-        docs_dict = json.load(docs_file)
-
+    dataset_dir = f"datasets/{name_dataset_without_digit}"
 
     # List all directories inside the 'label_synonyms/' directory
     label_synonyms_directories = {name for name in os.listdir('label_synonyms/') if os.path.isdir(os.path.join('label_synonyms/', name))}
     if name_dataset_without_digit not in label_synonyms_directories:
         raise ValueError("The filename of `path_to_train_data` must match one of the names of directories inside the `label_synonyms/` directory.")
+    return (store_path_for(dataset_dir, name_dataset_without_digit),
+            f"label_synonyms/{name_dataset_without_digit}",
+            os.path.join(dataset_dir, f"{name_dataset}_scores.npz"))
 
-    print("Processing:", name_dataset)
-    gzt_path = f"gazetteers/gzt_{name_dataset}_thr_{threshold:.2f}_lim_{limit}".replace('.', '_')
-    
-    label_doc_dict = get_label_synonyms2vecs(model, f"label_synonyms/{name_dataset_without_digit}")
-    os.makedirs(gzt_path, exist_ok=True)
 
-    freq_entity_true_label = {}
-    processed_entites = {}
+def _shard_store_path(store_path: str, shard: Shard) -> str:
+    shard_store_path = store_path_for(os.path.dirname(store_path), os.path.basename(store_path)[:-len("_ners.sqlite")], shard)
+    return shard_store_path if os.path.isfile(shard_store_path) else store_path
 
-    # START
+
+def _read_doc_ids(path_to_train_data: str) -> Generator[str, None, None]:
+    """
+    Yields the ids of the documents of a dataset file (its `# id` lines), in order.
+    """
     with open(path_to_train_data, 'r', encoding='utf-8') as fin:
-        total_lines = sum(1 for _ in fin)
-        fin.seek(0)
-        for line in tqdm(fin, desc="Mapping entities to gazetteer", total=total_lines):
-            if _is_divider(line) or not line.startswith("# id"):
-                continue
-            doc_id = line.strip().replace('\u200d', '').replace('\u200c', '').replace('\u200b', '').split()[-1]
-            entities = docs_dict.get(doc_id, [])
-            uniq_ents = set(entities)
-            for entity in uniq_ents:
-                if entity in processed_entites:
-                    continue
-                processed_entites[entity] = True
-                true_tag = ners_dict.get(entity, {}).get('tag', '')
-                if len(true_tag) == 0:
-                    continue
-                topics = ners_dict.get(entity, {}).get('wiki_topics', {})
-                if add_entity_to_gazetteer(model, entity, true_tag, topics, label_doc_dict, threshold, gzt_path):
-                    freq_entity_true_label[true_tag] = freq_entity_true_label.get(true_tag, 0) + 1
-
-    with open(gzt_path + "/coverage.txt", 'w', encoding='utf-8') as file:
-        for key, value in freq_entity_true_label.items():
-            file.write(f"{key} {value}\n")
+        for line in fin:
+            if line.startswith("# id") and not _is_divider(line):
+                yield line.strip().replace('\u200d', '').replace('\u200c', '').replace('\u200b', '').split()[-1]
 
 
+def gazetteer_entities(path_to_train_data: str, ner_store: NERStore, shard: Optional[Shard] = None) -> Generator[Tuple[int, str, Dict], None, None]:
+    """
+    Yields the tagged entities of a dataset as (rank, entity, ners_dict value), in the order they are added to the
+    gazetteers: by document, first occurrence only (see `ner_store.NERStore.iter_ranked_entities`).
+    The store of a dataset holds all of its documents, so only a fold (e.g. `rdrs1` of `rdrs`) is read for its document ids.
 
-if __name__ == "__main__":
-    model = spacy.load("en_core_web_lg")
-    sg = parse_args()
-    # dataset2NERdict() requires internent connection
-    dataset2NERdict(path_to_train_data=sg.data, limit=sg.limit, lang=sg.lang)
+    Args:
+        path_to_train_data (str): The path to the dataset or fold file.
+        ner_store (NERStore): The NER store of the dataset.
+        shard (Shard, optional): Only the entities of shard `i` of `n`, see `ner_store.entity_shard`.
+    """
+    name_dataset = os.path.basename(path_to_train_data)
+    doc_ids = None if name_dataset == re.sub(r'\d+', '', name_dataset) else _read_doc_ids(path_to_train_data)
+    for rank, entity, record in ner_store.iter_ranked_entities(doc_ids, shard):
+        if len(record.get('tag', '')) > 0:
+            yield rank, entity, record
+
+
+def compute_fold_scores(model: Union[spacy.language.Language, str], paths_to_train_data: List[str], topic_store: Optional[TopicVectorStore] = None, use_cache: bool = True,
+                        qid_index: Optional[QIDLabelIndex] = None, processes: int = 1, shard: Optional[Shard] = None) -> List[EntityScores]:
+    """
+    Computes the similarity of the tagged entities of one or more folds of a dataset (e.g. `rdrs1`..`rdrs5`,
+    which share the NER store of `rdrs`) to every label, see `entity_scores.EntityScores`.
+    The label synonyms are read once and the union of the entities of all folds is scored once;
+    the matrix of a fold is the selection of its entities' rows, in the fold's gazetteer order.
+
+    With a QID index (see `qid_labels.build_qid_label_index`) an entity with a topic QID in the index is resolved
+    without vectors: it scores 1.0 for the labels of its matching QIDs and -inf for the others. Only the topics of
+    the unresolved entities are embedded and scored.
+
+    The matrix of every fold is cached as `datasets/{dataset}/{fold}_scores.npz` (float16) and reused while the fold,
+    the NER store, the label synonyms and the model are unchanged.
+
+    Args:
+        model (Union[spacy.language.Language, str]): A pre-trained spaCy model, or its name to load it (vectors only) on a cache miss.
+        paths_to_train_data (List[str]): The paths to the fold files. !!!Caution: names of the files need to be the same with the label_synonyms file
+        topic_store (TopicVectorStore, optional): Persistent store of topic vectors, only topics missing from it are embedded.
+        use_cache (bool): Whether cached matrices may be returned (only when every fold is cached). Computed matrices are always cached.
+        qid_index (QIDLabelIndex, optional): The QID -> labels index of the QID fast path.
+        processes (int): The number of processes scoring the topics, see `entity_scores.score_entities`.
+        shard (Shard, optional): Only score the entities of shard `i` of `n` (cached as `{fold}_scores.shard{i}of{n}.npz`),
+            read from the store of the shard when there is one.
+
+    Returns:
+        List[EntityScores]: The scores of every fold, float32 when computed, float16 when read from the cache.
+    """
+    dataset_files = [_dataset_files(path) for path in paths_to_train_data]
+    if shard is not None:
+        # the store of the shard written by `dataset2NERdict`, or the store of the whole dataset
+        dataset_files = [(_shard_store_path(store, shard), synonyms, f"{scores[:-len('.npz')]}.shard{shard[0]}of{shard[1]}.npz")
+                         for store, synonyms, scores in dataset_files]
+    if len({files[:2] for files in dataset_files}) > 1:
+        raise ValueError("The folds of `paths_to_train_data` must belong to the same dataset.")
+    store_path, synonyms_dir, _ = dataset_files[0]
+    ner_store = open_ner_store(store_path)
+    synonym_files = [os.path.join(synonyms_dir, filename) for filename in sorted(os.listdir(synonyms_dir)) if filename.endswith(".txt")]
+    model_name = get_model_name(model)
+    extra = index_fingerprint(qid_index) if qid_index else ""
+    if shard is not None:
+        extra += f"|{SHARD_SCHEME}"
+    fingerprints = [scores_fingerprint(model_name, [path, store_path] + synonym_files, extra) for path in paths_to_train_data]
+    if use_cache:
+        cached = [load_cached_scores(files[2], fingerprint) for files, fingerprint in zip(dataset_files, fingerprints)]
+        if all(scores is not None for scores in cached):
+            print(f"Using the similarity scores cached in {', '.join(files[2] for files in dataset_files)}")
+            return cached
+
+    model = resolve_model(model)
+    label_doc_dict = get_label_synonyms2vecs(model, synonyms_dir)
+    engine = LabelSimilarityEngine(label_doc_dict)
+
+    fold_entities = []
+    fold_ranks = []
+    records = {}
+    for path in tqdm(paths_to_train_data, desc="Mapping entities to gazetteer"):
+        entities = []
+        ranks = []
+        for rank, entity, record in gazetteer_entities(path, ner_store, shard):
+            ranks.append(rank)
+            entities.append(entity)
+            records.setdefault(entity, record)
+        fold_entities.append(entities)
+        fold_ranks.append(ranks)
+    entity_rows = {entity: row for row, entity in enumerate(records)}
+
+    entity_topics = [record.get('wiki_topics', {}) for record in records.values()]
+    label_index = {label: j for j, label in enumerate(engine.labels)}
+    matched = [[label for label in match_labels(qid_index, topics.values()) if label in label_index] if qid_index else []
+               for topics in entity_topics]
+    unresolved = [row for row, labels in enumerate(matched) if not labels]
+    if qid_index:
+        print(f"{len(entity_topics) - len(unresolved)} of {len(entity_topics)} entities resolved by topic QID")
+
+    # embed every distinct topic of the unresolved entities once, topics already in the store are not passed through the model again
+    unresolved_topics = [entity_topics[row] for row in unresolved]
+    topic_keys = list(dict.fromkeys((qid, topic) for topics in unresolved_topics for topic, qid in topics.items()))
+    topic_matrix = embed_topics(model, topic_keys, topic_store)
+    topic_rows = {key: row for row, key in enumerate(topic_keys)}
+    union_scores = np.full((len(entity_topics), len(engine.labels)), -np.inf, dtype=np.float32)
+    union_scores[unresolved] = score_entities(engine, unresolved_topics, topic_matrix, topic_rows, processes=processes)
+    for row, labels in enumerate(matched):
+        union_scores[row, [label_index[label] for label in labels]] = 1.0
+
+    fold_scores = []
+    for entities, ranks, files, fingerprint in zip(fold_entities, fold_ranks, dataset_files, fingerprints):
+        rows = np.asarray([entity_rows[entity] for entity in entities], dtype=np.int64)
+        scores = EntityScores(entities, [records[entity]['tag'] for entity in entities], engine.labels,
+                              union_scores[rows], fingerprint, ranks)
+        scores.save(files[2])
+        fold_scores.append(scores)
+    return fold_scores
+
+
+def _gazetteer_path(path_to_train_data: str, threshold: float, limit: int) -> str:
+    return f"gazetteers/gzt_{os.path.basename(path_to_train_data)}_thr_{threshold:.2f}_lim_{limit}".replace('.', '_')
+
+
+def _partial_gazetteer_path(gzt_path: str, shard: Shard) -> str:
+    return os.path.join(os.path.dirname(gzt_path), "shards", os.path.basename(gzt_path), f"shard{shard[0]}of{shard[1]}")
+
+
+def _write_fold_gazetteers(scores: EntityScores, gzt_paths: List[Tuple[str, float]], sort: bool = False, shard: Optional[Shard] = None) -> None:
+    for gzt_path, threshold in gzt_paths:
+        if shard is not None:
+            scores.write_partial_gazetteers(_partial_gazetteer_path(gzt_path, shard), threshold)
+        else:
+            scores.write_gazetteers(gzt_path, threshold, sort)
+
+
+def make_fold_gazetteers(model: Union[spacy.language.Language, str], paths_to_train_data: List[str], thresholds: List[float], limit: int, lang: str,
+                         topic_store: Optional[TopicVectorStore] = None, sweep: bool = False, processes: int = 1,
+                         qid_index: Optional[QIDLabelIndex] = None, sort: bool = False, shard: Optional[Shard] = None) -> None:
+    """
+    Creates the gazetteers of several folds of a dataset (and thresholds) from one similarity pass over the union of
+    their entities (see `compute_fold_scores`), so a five-fold build costs about as much as one fold.
+
+    With a shard `i/n` only the entities of the shard are scored, into partial gazetteers
+    `gazetteers/shards/gzt_*/shard{i}of{n}/` that `merge_fold_gazetteers` merges once every shard is done.
 
-    if os.path.basename(sg.data) != 'rdrs':
-        # make_gazetteer() does not require internent connection
-        make_gazetteer(model=model, path_to_train_data=sg.data, threshold=sg.threshold, limit=sg.limit, lang=sg.lang)
+    A single threshold is compared at full precision. A sweep compares all thresholds against the float16 scores
+    of the cache, so an entity whose score is within about 1e-3 of a threshold may land on the other side.
+
+    Args:
+        model (Union[spacy.language.Language, str]): A pre-trained spaCy model or its name, see `compute_fold_scores`.
+        paths_to_train_data (List[str]): The paths to the fold files, e.g. `datasets/rdrs/rdrs1`..`rdrs5`.
+        thresholds (List[float]): The similarity thresholds, one gazetteer directory per fold and threshold.
+        limit (int): The maximum number of topics to extract for each entity.
+        lang (str): The language of the dataset.
+        topic_store (TopicVectorStore, optional): Persistent store of topic vectors.
+        sweep (bool): Whether to read cached scores and compare against float16 scores.
+        processes (int): The number of processes scoring the topics and writing the gazetteers of the folds.
+        qid_index (QIDLabelIndex, optional): The QID -> labels index of the QID fast path, see `compute_fold_scores`.
+        sort (bool): Whether the gazetteer files are sorted instead of in entity order.
+        shard (Shard, optional): Only build the partial gazetteers of shard `i` of `n`.
+    """
+    print("Processing:", ', '.join(os.path.basename(path) for path in paths_to_train_data))
+    # computed at full precision for a single run, the float16 cache is only read by sweeps
+    fold_scores = compute_fold_scores(model, paths_to_train_data, topic_store, use_cache=sweep, qid_index=qid_index, processes=processes, shard=shard)
+    jobs = []
+    for path, scores in zip(paths_to_train_data, fold_scores):
+        if sweep:
+            scores.scores = scores.scores.astype(np.float16)
+        jobs.append((scores, [(_gazetteer_path(path, threshold, limit), threshold) for threshold in thresholds], sort, shard))
+
+    if processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, len(jobs))) as executor:
+            list(tqdm(executor.map(_write_fold_gazetteers, *zip(*jobs)), total=len(jobs), desc="Writing gazetteers"))
     else:
-        for i in range(1, 6):
-            make_gazetteer(model=model, path_to_train_data=f"{sg.data}{i}", threshold=sg.threshold, limit=sg.limit, lang=sg.lang)
+        for job in tqdm(jobs, desc="Writing gazetteers"):
+            _write_fold_gazetteers(*job)
 
 
+def merge_fold_gazetteers(paths_to_train_data: List[str], thresholds: List[float], limit: int, n_shards: int, sort: bool = False) -> None:
+    """
+    Merges the partial gazetteers of the `n_shards` shards of `make_fold_gazetteers` into the `gzt_*` directory of
+    every fold and threshold (see `entity_scores.merge_partial_gazetteers`). The result is byte-identical to an
+    unsharded build, whatever the number of shards.
+    """
+    for path in paths_to_train_data:
+        for threshold in tqdm(thresholds, desc=f"Merging the gazetteers of {os.path.basename(path)}"):
+            gzt_path = _gazetteer_path(path, threshold, limit)
+            merge_partial_gazetteers([_partial_gazetteer_path(gzt_path, (i, n_shards)) for i in range(n_shards)], gzt_path, sort)
 
 
+if __name__ == "__main__":
+    sg = parse_args()
+    data_paths = [sg.data] if os.path.basename(sg.data) != 'rdrs' else [f"{sg.data}{i}" for i in range(1, 6)]
+    thresholds = parse_thresholds(sg.thresholds) if sg.thresholds else [sg.threshold]
+    if sg.merge_shards:
+        # merge stage of a sharded build, once every `--shard i/n` run is done
+        merge_fold_gazetteers(data_paths, thresholds, sg.limit, sg.merge_shards, sort=sg.sort_gazetteers)
+    else:
+        shard = parse_shard(sg.shard) if sg.shard else None
+
+        # loaded (tokenizer and vectors only) when the similarity stage needs it
+        model = sg.spacy_model
+        topic_store = TopicVectorStore(sg.topic_cache, get_model_name(model))
+        wiki_http.configure(rate=sg.rate, pool_size=sg.workers, cache_path=sg.http_cache, cache_ttl=sg.http_cache_ttl * 24 * 3600)
+        # dataset2NERdict() requires internent connection
+        dataset2NERdict(path_to_train_data=sg.data, limit=sg.limit, lang=sg.lang, workers=sg.workers, search_backend=sg.search_backend, wikidata_index=sg.wikidata_index,
+                        shard=shard)
+
+        # the folds of rdrs share one similarity pass; make_fold_gazetteers() does not require internent connection
+        qid_index = None
+        if sg.qid_fast_path:
+            taxonomy_directory = find_taxonomy_directory(re.sub(r'\d+', '', os.path.basename(sg.data)), sg.lang)
+            if taxonomy_directory is None:
+                raise ValueError(f"--qid_fast_path needs a taxonomy directory in label_taxonomy/ for {os.path.basename(sg.data)}")
+            qid_index = build_qid_label_index(taxonomy_directory, SubclassClosure.load(sg.closure) if sg.closure else None)
+        make_fold_gazetteers(model=model, paths_to_train_data=data_paths, thresholds=thresholds, limit=sg.limit, lang=sg.lang,
+                             topic_store=topic_store, sweep=bool(sg.thresholds), processes=sg.processes, qid_index=qid_index,
+                             sort=sg.sort_gazetteers, shard=shard)
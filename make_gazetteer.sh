@@ -6,6 +6,9 @@ THRESHOLD=${1:-0.90}
 LIMIT=${2:-10}
 LAN=${3:-"en"}
 CORPUS=${4:-"multiconer"}
+WORKERS=${5:-4}
+SHARDS=${6:-1}
+RATE=${7:-5}
 
 base_dir=${REPO}
 train_file=${DATA_DIR}/${CORPUS}/${CORPUS}
@@ -16,5 +19,26 @@ if [ ! -f "$train_file" ]; then
     exit 1
 fi
 
+args=(--data "$train_file" --threshold "$THRESHOLD" --limit "$LIMIT" --lang "$LAN")
+
 # Execute the Python module with dynamic parameters
-python -m make_gazetteer --data "$train_file" --threshold "$THRESHOLD" --limit "$LIMIT" --lang "$LAN"
\ No newline at end of file
+if [ "$SHARDS" -le 1 ]; then
+    python -m make_gazetteer "${args[@]}" --workers "$WORKERS" --rate "$RATE"
+    exit $?
+fi
+
+# Sharded build: one local worker process per shard, then the merge.
+# The shards share the Wikidata request rate, each one gets its part of it.
+shard_rate=$(awk -v rate="$RATE" -v shards="$SHARDS" 'BEGIN { print rate / shards }')
+pids=()
+for ((i = 0; i < SHARDS; i++)); do
+    python -m make_gazetteer "${args[@]}" --workers "$WORKERS" --rate "$shard_rate" --shard "$i/$SHARDS" &
+    pids+=($!)
+done
+for pid in "${pids[@]}"; do
+    if ! wait "$pid"; then
+        echo "A shard failed, not merging"
+        exit 1
+    fi
+done
+python -m make_gazetteer "${args[@]}" --merge_shards "$SHARDS"
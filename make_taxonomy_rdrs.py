@@ -2,6 +2,8 @@ from tqdm import tqdm
 from search_wiki_data import *
 from make_gazetteer import *
 from datasets.process_multiconer import _is_divider
+from http_cache import DEFAULT_CACHE_PATH
+import wiki_http
 
 
 def write_to_file(file_path, mydict):
@@ -58,4 +60,5 @@ if __name__=="__main__":
     limit = 5
     path_to_rdrs_processed_corpus = "xxxtest/test1111.txt"
     out_put_file_path = "rdrs_entity_topics_dict.json"
+    wiki_http.configure(cache_path=DEFAULT_CACHE_PATH)
     dump_entity_topics_dict_to_file(path_to_rdrs_processed_corpus, "en", 5, out_put_file_path)
\ No newline at end of file
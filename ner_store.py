@@ -0,0 +1,248 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
+
+Shard = Tuple[int, int]
+# identifies how `entity_shard` partitions the entities, part of the fingerprint of the scores cached per shard
+SHARD_SCHEME = "blake2b-8:normalize_query"
+_temp_tables = itertools.count()
+
+
+def parse_shard(spec: str) -> Shard:
+    """
+    Parses a shard spec `i/n` (0 <= i < n): the i-th of n hash partitions of the entities.
+    """
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"A shard is given as i/n, got {spec!r}") from None
+    if not 0 <= index < count:
+        raise ValueError(f"The shard index must be in [0, {count}), got {spec!r}")
+    return index, count
+
+
+def normalize_query(entity: str) -> str:
+    """
+    Normalizes an entity to the key of its search. The search is case-insensitive and ignores repeated whitespace,
+    so entities that only differ in those share one search. The key is never sent to Wikidata: the search is run
+    with the surface form of the first of those entities.
+    """
+    return ' '.join(entity.split()).casefold()
+
+
+def entity_shard(entity: str, n_shards: int) -> int:
+    """
+    Returns the shard of an entity: a stable hash of its search key (see `normalize_query`) modulo the number of
+    shards, so the entities sharing a search are searched once, in the same shard.
+    """
+    return int.from_bytes(hashlib.blake2b(normalize_query(entity).encode('utf-8'), digest_size=8).digest(), 'little') % n_shards
+
+
+class NERStore:
+    """
+    Read-only SQLite store of the output of `dataset2NERdict`, in place of `*_ners_dict.json` and `*_docs_dict.json`.
+
+    `entities` holds one row per entity in order of first occurrence in the documents (tag, `wiki_topics` and
+    `txt_id_list` as JSON) and `docs` one row per document with its entities, in corpus order. Entities and documents
+    are looked up by key with an index, and both tables are iterated with a cursor, so neither dict is ever loaded
+    as a whole.
+    """
+
+    def __init__(self, path: str):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"The NER store was not found: {path}")
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._local.conn = conn
+        return conn
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+
+    def get(self, entity: str, default: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        Returns the ners_dict value of an entity: {'txt_id_list', 'wiki_topics', 'tag'}.
+        """
+        row = self._connection().execute("SELECT tag, topics, doc_ids FROM entities WHERE entity = ?", (entity,)).fetchone()
+        return _record(*row) if row is not None else default
+
+    def get_doc(self, doc_id: str, default: Optional[List[str]] = None) -> Optional[List[str]]:
+        """
+        Returns the docs_dict value of a document: its entities, in order of occurrence.
+        """
+        row = self._connection().execute("SELECT entities FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def iter_entities(self, doc_ids: Optional[Iterable[str]] = None, shard: Optional[Shard] = None,
+                      batch_size: int = 10000) -> Generator[Tuple[str, Dict], None, None]:
+        """
+        Yields every distinct entity once, with its ners_dict value, in order of first occurrence.
+
+        Args:
+            doc_ids (Iterable[str], optional): Only the entities of these documents (e.g. of a fold), first seen in this
+                order of the documents. The selection and the ordering are done by SQLite, without a dict per entity.
+            shard (Shard, optional): Only the entities of shard `i` of `n`, see `entity_shard`.
+            batch_size (int): The number of rows fetched at a time.
+        """
+        for _, entity, record in self.iter_ranked_entities(doc_ids, shard, batch_size):
+            yield entity, record
+
+    def iter_ranked_entities(self, doc_ids: Optional[Iterable[str]] = None, shard: Optional[Shard] = None,
+                             batch_size: int = 10000) -> Generator[Tuple[int, str, Dict], None, None]:
+        """
+        Yields (rank, entity, ners_dict value) like `iter_entities`. The rank is the position of the first occurrence of
+        the entity (its row id, or the position of its document and its position in the document for `doc_ids`),
+        the same in the store of a shard as in the store of the whole dataset.
+        """
+        conn = self._connection()
+        if doc_ids is None:
+            cursor = conn.execute("SELECT id, entity, tag, topics, doc_ids FROM entities ORDER BY id")
+            yield from self._iter_rows(cursor, shard, batch_size)
+            return
+        table = f"selected_docs{next(_temp_tables)}"
+        conn.execute(f"CREATE TEMP TABLE {table} (position INTEGER PRIMARY KEY, doc_id TEXT)")
+        try:
+            with conn:
+                conn.executemany(f"INSERT INTO {table} (doc_id) VALUES (?)", ((doc_id,) for doc_id in doc_ids))
+            # first occurrence = position of the document, then position in the document
+            width = (conn.execute("SELECT MAX(json_array_length(entities)) FROM docs").fetchone()[0] or 0) + 1
+            cursor = conn.execute(f"""
+                SELECT f.first, e.entity, e.tag, e.topics, e.doc_ids
+                FROM (SELECT j.value AS entity, MIN(s.position * ? + j.key) AS first
+                      FROM {table} s JOIN docs d ON d.doc_id = s.doc_id, json_each(d.entities) j
+                      GROUP BY j.value) f
+                JOIN entities e ON e.entity = f.entity
+                ORDER BY f.first""", (width,))
+            yield from self._iter_rows(cursor, shard, batch_size)
+        finally:
+            conn.execute(f"DROP TABLE {table}")
+
+    @staticmethod
+    def _iter_rows(cursor: sqlite3.Cursor, shard: Optional[Shard], batch_size: int) -> Generator[Tuple[int, str, Dict], None, None]:
+        for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+            for rank, entity, tag, topics, doc_ids in rows:
+                if shard is None or entity_shard(entity, shard[1]) == shard[0]:
+                    yield rank, entity, _record(tag, topics, doc_ids)
+
+    def iter_docs(self, batch_size: int = 10000) -> Generator[Tuple[str, List[str]], None, None]:
+        """
+        Yields (doc id, entities of the doc) in corpus order.
+        """
+        cursor = self._connection().execute("SELECT doc_id, entities FROM docs ORDER BY id")
+        for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+            for doc_id, entities in rows:
+                yield doc_id, json.loads(entities)
+
+
+def _record(tag: str, topics: str, doc_ids: str) -> Dict:
+    return {'txt_id_list': json.loads(doc_ids), 'wiki_topics': json.loads(topics), 'tag': tag}
+
+
+def write_ner_store(path: str, results: Iterable[Tuple[str, Dict]], docs: Iterable[Tuple[str, List[str]]], batch_size: int = 10000,
+                    entity_ids: Optional[Iterable[int]] = None) -> None:
+    """
+    Writes a NER store from (entity, ners_dict value) and (doc id, entities) pairs, each in corpus order.
+    The store is written to a temporary file and renamed when complete.
+
+    `entity_ids` are the row ids of the entities, by default their position from 1. The store of a shard holds only
+    the entities of the shard under their ids in the whole dataset, and all the documents.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE entities (id INTEGER PRIMARY KEY, entity TEXT UNIQUE, tag TEXT, topics TEXT, doc_ids TEXT)")
+    conn.execute("CREATE TABLE docs (id INTEGER PRIMARY KEY, doc_id TEXT UNIQUE, entities TEXT)")
+    entity_rows = ((row_id, entity, record.get('tag', ''), json.dumps(record.get('wiki_topics', {}), ensure_ascii=False),
+                    json.dumps(record.get('txt_id_list', []), ensure_ascii=False))
+                   for row_id, (entity, record) in zip(entity_ids if entity_ids is not None else itertools.count(1), results))
+    doc_rows = ((doc_id, json.dumps(entities, ensure_ascii=False)) for doc_id, entities in docs)
+    for table, columns, rows in (("entities", "id, entity, tag, topics, doc_ids", entity_rows), ("docs", "doc_id, entities", doc_rows)):
+        placeholders = ', '.join('?' * len(columns.split(', ')))
+        for batch in iter(lambda: [row for _, row in zip(range(batch_size), rows)], []):
+            with conn:
+                conn.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", batch)
+    conn.close()
+    os.replace(tmp_path, path)
+
+
+def read_results_log(log_path: str) -> Generator[Tuple[str, Dict], None, None]:
+    """
+    Yields the (entity, ners_dict value) records of a `*_ners_log.jsonl` written by `dataset2NERdict`,
+    skipping a line cut short by a crash.
+    """
+    with open(log_path, 'r', encoding='utf-8') as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield record.pop('entity'), record
+
+
+def convert_json(ners_json_path: str, docs_json_path: str, store_path: str) -> None:
+    """
+    Converts the `*_ners_dict.json` and `*_docs_dict.json` of `dataset2NERdict` to a NER store.
+    The entities are stored in order of first occurrence in the documents, as `dataset2NERdict` writes them.
+    """
+    with open(ners_json_path, 'r', encoding='utf-8') as file:
+        ners_dict = json.load(file)
+    with open(docs_json_path, 'r', encoding='utf-8') as file:
+        docs_dict = json.load(file)
+    order = dict.fromkeys(entity for entities in docs_dict.values() for entity in entities if entity in ners_dict)
+    order.update(dict.fromkeys(ners_dict))
+    write_ner_store(store_path, ((entity, ners_dict[entity]) for entity in order), docs_dict.items())
+
+
+def store_path_for(dataset_dir: str, name_dataset: str, shard: Optional[Shard] = None) -> str:
+    if shard is not None:
+        return os.path.join(dataset_dir, f"{name_dataset}_ners.shard{shard[0]}of{shard[1]}.sqlite")
+    return os.path.join(dataset_dir, f"{name_dataset}_ners.sqlite")
+
+
+def open_ner_store(store_path: str) -> NERStore:
+    """
+    Opens a NER store (see `store_path_for`). When only the JSON files of an older run exist next to it
+    (`{dataset}_ners_dict.json` and `{dataset}_docs_dict.json`), they are converted once.
+    """
+    prefix = store_path[:-len("_ners.sqlite")]
+    ners_json_path, docs_json_path = f"{prefix}_ners_dict.json", f"{prefix}_docs_dict.json"
+    if not os.path.isfile(store_path) and os.path.isfile(ners_json_path) and os.path.isfile(docs_json_path):
+        print(f"Converting {ners_json_path} and {docs_json_path} to {store_path}")
+        convert_json(ners_json_path, docs_json_path, store_path)
+    return NERStore(store_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the output of dataset2NERdict to a NER store.', add_help=False)
+    parser.add_argument('--ners_json', type=str, help='The *_ners_dict.json to convert.', default=None)
+    parser.add_argument('--docs_json', type=str, help='The *_docs_dict.json to convert.', default=None)
+    parser.add_argument('--log', type=str, help='A *_ners_log.jsonl to convert instead of --ners_json (needs --docs_json or --data).', default=None)
+    parser.add_argument('--data', type=str, help='The processed dataset the docs are read from, instead of --docs_json.', default=None)
+    parser.add_argument('--out', type=str, help='Path of the store to write.')
+    sg = parser.parse_args()
+
+    if sg.log:
+        if sg.docs_json:
+            with open(sg.docs_json, 'r', encoding='utf-8') as file:
+                docs = json.load(file).items()
+        else:
+            from make_gazetteer import plan_entity_queries
+            docs = plan_entity_queries(sg.data)[0].items()
+        write_ner_store(sg.out, read_results_log(sg.log), docs)
+    else:
+        convert_json(sg.ners_json, sg.docs_json, sg.out)
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+from subclass_closure import SubclassClosure
+
+QIDLabelIndex = Dict[str, Tuple[str, ...]]
+
+
+def find_taxonomy_directory(dataset: str, lang: str, root: str = "label_taxonomy") -> Optional[str]:
+    """
+    Returns the taxonomy directory of a dataset: `label_taxonomy/{dataset}_{lang}` (e.g. `multiconer_en`)
+    or `label_taxonomy/{dataset}` (e.g. `rdrs`), None when there is neither.
+    """
+    for name in (f"{dataset}_{lang}", dataset):
+        directory = os.path.join(root, name)
+        if os.path.isdir(directory):
+            return directory
+    return None
+
+
+def build_qid_label_index(taxonomy_directory: str, closure: Optional[SubclassClosure] = None) -> QIDLabelIndex:
+    """
+    Maps the QIDs of the `name | QID` lines of the taxonomy files (one file per label) to their labels.
+    With a subclass closure every QID also stands for all its transitive subclasses.
+    A QID listed under several labels (e.g. film for CW and PROD) maps to all of them.
+
+    Args:
+        taxonomy_directory (str): The directory of the taxonomy files, e.g. `label_taxonomy/multiconer_en`.
+        closure (SubclassClosure, optional): The P279 hierarchy used to expand the QIDs.
+
+    Returns:
+        QIDLabelIndex: QID -> labels, in the order of the files.
+    """
+    index: Dict[str, Dict[str, None]] = {}
+    for filename in sorted(os.listdir(taxonomy_directory)):
+        if not filename.endswith(".txt"):
+            continue
+        label = filename[:-4]
+        with open(os.path.join(taxonomy_directory, filename), 'r', encoding='utf-8') as reader:
+            qids = [line.split()[-1] for line in reader if line.strip()]
+        for qid in qids:
+            for descendant in (closure.descendants(qid) if closure is not None else [qid]):
+                index.setdefault(descendant, {})[label] = None
+    return {qid: tuple(labels) for qid, labels in index.items()}
+
+
+def match_labels(qid_index: QIDLabelIndex, topic_qids: Iterable[str]) -> List[str]:
+    """
+    Returns the labels of the topic QIDs of an entity found in the index, in order of first match.
+    """
+    labels: Dict[str, None] = {}
+    for qid in topic_qids:
+        for label in qid_index.get(qid, ()):
+            labels[label] = None
+    return list(labels)
+
+
+def index_fingerprint(qid_index: QIDLabelIndex) -> str:
+    return hashlib.sha256(json.dumps(sorted(qid_index.items())).encode('utf-8')).hexdigest()
@@ -1,12 +1,95 @@
 import requests
 from bs4 import BeautifulSoup
 import logging
-from typing import Generator, Tuple, Dict
+import re
+import wiki_http
+from wikidata_dump_index import DEFAULT_INDEX_PATH, WikidataIndex
+from typing import Generator, Iterable, List, Optional, Tuple, Dict
 
 url = "https://www.wikidata.org/w/index.php"
 api_url = "https://www.wikidata.org/w/api.php"
 
 
+# wbgetentities accepts at most 50 ids per request
+MAX_IDS_PER_REQUEST = 50
+ENTITY_ID_PATTERN = re.compile(r"^[QPL]\d+$")
+
+
+def get_entities(api_url: str, ids: Iterable[str], props: str, lang: Optional[str] = None) -> Dict[str, Dict]:
+    """
+    Retrieves entities from the Wikidata API with as few `wbgetentities` requests as possible,
+    sending up to `MAX_IDS_PER_REQUEST` de-duplicated ids per request (`ids=Q1|Q2|...`).
+    Ids that are not entity ids (e.g. `Property:P31` from the search page) are skipped, as a request
+    for them alone would fail and a batch containing them would fail as a whole.
+
+    Args:
+        api_url (str): The URL of the Wikidata API.
+        ids (Iterable[str]): The entity ids to retrieve.
+        props (str): The entity parts to return, e.g. "claims" or "labels".
+        lang (str, optional): Restricts labels, descriptions and aliases to this language.
+
+    Returns:
+        Dict[str, Dict]: The retrieved entities by id.
+    """
+    unique_ids = [entity_id for entity_id in dict.fromkeys(ids) if ENTITY_ID_PATTERN.match(entity_id)]
+    entities = {}
+    for start in range(0, len(unique_ids), MAX_IDS_PER_REQUEST):
+        params = {
+            "action": "wbgetentities",
+            "format": "json",
+            "ids": "|".join(unique_ids[start:start + MAX_IDS_PER_REQUEST]),
+            "props": props,
+            "maxlag": wiki_http.MAXLAG
+        }
+        if lang:
+            params["languages"] = lang
+        response = wiki_http.get(api_url, params=params)
+        response.raise_for_status()
+        answer = response.json()
+        if "error" in answer:
+            # e.g. maxlag after the retries or a database timeout, reported with HTTP 200
+            raise ValueError(f"Wikidata API error: {answer['error'].get('code')}: {answer['error'].get('info')}")
+        entities.update(answer.get("entities", {}))
+    return entities
+
+
+def get_P31_ids(entity: Dict) -> List[str]:
+    """
+    Returns the ids of the P31 ("instance of") values of an entity retrieved with `props=claims`.
+    """
+    claims = entity.get("claims", {})
+    list_of_topics = claims.get("P31", [])
+    # list_of_topics.extend(claims.get("P279", []))
+    entity_ids = [topic.get("mainsnak", {}).get("datavalue", {}).get("value", {}).get("id") for topic in list_of_topics]
+    return [entity_id for entity_id in entity_ids if entity_id]
+
+
+def resolve_topics(api_url: str, page_ids: List[str], lang: str) -> Generator[Tuple[str, str], None, None]:
+    """
+    Retrieves the P31 ("instance of") topics of a batch of pages with batched `wbgetentities` requests:
+    claims of all pages first, then the labels of all distinct topic ids.
+    Yields the topics page by page, in the order the pages and their P31 values are listed.
+
+    Args:
+        api_url (str): The URL of the Wikidata API.
+        page_ids (List[str]): The ids of the pages for which topics are being retrieved.
+        lang (str): The language code for the labels of the retrieved topics.
+
+    Yields:
+        Tuple[str, str]: A tuple containing the topic name and its corresponding entity ID.
+    """
+    pages = get_entities(api_url, page_ids, "claims")
+    topic_ids_per_page = [get_P31_ids(pages.get(page_id, {})) for page_id in page_ids]
+    topics = get_entities(api_url, (entity_id for topic_ids in topic_ids_per_page for entity_id in topic_ids), "labels", lang)
+    for topic_ids in topic_ids_per_page:
+        for entity_id in topic_ids:
+            labels = topics.get(entity_id, {}).get("labels", {})
+            if lang in labels:
+                topic_name = labels[lang].get("value")
+                if topic_name:
+                    yield (topic_name, entity_id)
+
+
 def get_instances_by_property_P31(api_url: str, page_id: str, lang: str) -> Generator[Tuple[str, str], None, None]:
     """
     Retrieves instances that are possibly related to a given instance based on the P31 ("instance of") property in Wikidata.
@@ -20,49 +103,161 @@ def get_instances_by_property_P31(api_url: str, page_id: str, lang: str) -> Gene
     Yields:
         Tuple[str, str]: A tuple containing the topic name and its corresponding entity ID.
     """
-    page_params = {
-        "action": "wbgetentities",
-        "format": "json",
-        "ids": page_id
-    }
-    page_response = requests.get(api_url, params=page_params)
-    claims = page_response.json().get("entities", {}).get(page_id, {}).get("claims", {})
-    list_of_topics = []
-    
-    if "P31" in claims:
-        list_of_topics = claims["P31"]
-    
-    # if "P279" in claims:
-    #     list_of_topics.extend(claims["P279"])
-        
-    for topic in list_of_topics:
-        entity_id = topic.get("mainsnak", {}).get("datavalue", {}).get("value", {}).get("id")
-        
-        if entity_id:
-            params = {
-                "action": "wbgetentities",
-                "format": "json",
-                "ids": entity_id
-            }
-            response = requests.get(api_url, params=params)
-            labels = response.json().get("entities", {}).get(entity_id, {}).get("labels", {})
-            
-            if lang in labels:
-                topic_name = labels[lang].get("value")
-                
+    yield from resolve_topics(api_url, [page_id], lang)
+
+
+class SearchBackend:
+    """
+    Finds the Wikidata pages matching a query and resolves their P31 topics.
+    Subclasses implement `search`; topics are resolved with batched `wbgetentities` requests unless overridden.
+    """
+    name = ""
+
+    def __init__(self, api_url: str = api_url, fallback: Optional["SearchBackend"] = None):
+        self.api_url = api_url
+        self.fallback = fallback
+
+    def search(self, query: str, lang: str, limit: int) -> List[str]:
+        """
+        Returns the ids of the pages found for `query`, in ranking order. If the backend fails and has a fallback,
+        the fallback answers instead.
+        """
+        try:
+            return self._search(query, lang, limit)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            if self.fallback is None:
+                raise
+            logging.error(f"{self.name} search failed for query \"{query}\", falling back to {self.fallback.name}: {e}")
+            return self.fallback.search(query, lang, limit)
+
+    def _search(self, query: str, lang: str, limit: int) -> List[str]:
+        raise NotImplementedError
+
+    def resolve_topics(self, page_ids: List[str], lang: str) -> Generator[Tuple[str, str], None, None]:
+        return resolve_topics(self.api_url, page_ids, lang)
+
+
+class HTMLSearchBackend(SearchBackend):
+    """
+    Scrapes the rendered `Special:Search` page.
+    """
+    name = "html"
+
+    def __init__(self, url: str = url, api_url: str = api_url, fallback: Optional[SearchBackend] = None):
+        super().__init__(api_url, fallback)
+        self.url = url
+
+    def _search(self, query: str, lang: str, limit: int) -> List[str]:
+        params = {
+            "title": "Special:Search",
+            "limit": limit,
+            "offset": 0,
+            "ns0": 1,
+            "ns120": 1,
+            "search": query
+        }
+        response = wiki_http.get(self.url, params=params)
+        response.raise_for_status()  # Raises an HTTPError if the response status code is 4XX or 5XX
+        soup = BeautifulSoup(response.content, "html.parser")
+        # Find all search result items
+        search_results = soup.find_all("div", class_="mw-search-result-heading")
+        # Extract IDs from search results
+        return [result.find("a").get("href").split("/")[-1] for result in search_results if result.find("a")]
+
+
+class APISearchBackend(SearchBackend):
+    """
+    Uses the JSON search API (`action=query&list=search`), which runs the same search as `Special:Search`
+    over items (namespace 0) and properties (namespace 120) and only returns the page titles.
+    """
+    name = "api"
+
+    def _search(self, query: str, lang: str, limit: int) -> List[str]:
+        params = {
+            "action": "query",
+            "format": "json",
+            "list": "search",
+            "srsearch": query,
+            "srnamespace": "0|120",
+            "srlimit": limit,
+            "srprop": "",
+            "srinfo": "",
+            "maxlag": wiki_http.MAXLAG
+        }
+        response = wiki_http.get(self.api_url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        if "error" in data:
+            raise ValueError(data["error"].get("info", data["error"]))
+        return [result["title"] for result in data["query"]["search"]]
+
+
+class EntitySearchBackend(SearchBackend):
+    """
+    Uses `wbsearchentities`, which matches labels and aliases in `lang` by prefix instead of running a full-text search.
+    """
+    name = "entities"
+
+    def _search(self, query: str, lang: str, limit: int) -> List[str]:
+        params = {
+            "action": "wbsearchentities",
+            "format": "json",
+            "search": query,
+            "language": lang,
+            "type": "item",
+            "limit": limit,
+            "maxlag": wiki_http.MAXLAG
+        }
+        response = wiki_http.get(self.api_url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        if "error" in data:
+            raise ValueError(data["error"].get("info", data["error"]))
+        return [result["id"] for result in data["search"]]
+
+
+class OfflineSearchBackend(SearchBackend):
+    """
+    Answers from the offline index built by `wikidata_dump_index` without any network access:
+    items whose label or alias equals the query, and their P31 topics.
+    """
+    name = "offline"
+
+    def __init__(self, index_path: str = DEFAULT_INDEX_PATH):
+        super().__init__()
+        self.index = WikidataIndex(index_path)
+
+    def _search(self, query: str, lang: str, limit: int) -> List[str]:
+        return list(self.index.search(query, lang, limit))
+
+    def resolve_topics(self, page_ids: List[str], lang: str) -> Generator[Tuple[str, str], None, None]:
+        for page_id in page_ids:
+            for entity_id in self.index.get_claims(page_id, 31):
+                topic_name = self.index.get_label(entity_id, lang)
                 if topic_name:
                     yield (topic_name, entity_id)
 
 
-# """
-# Once you got those ids, you just need to request entities labels using the wbgetentities API:
-# https://www.wikidata.org/w/api.php?action=wbgetentities&ids=Q775450|Q3041294|Q646968|Q434841|Q11920&format=json&props=labels
+SEARCH_BACKENDS = {backend.name: backend for backend in (APISearchBackend, EntitySearchBackend, HTMLSearchBackend, OfflineSearchBackend)}
+DEFAULT_SEARCH_BACKEND = "api"
 
-# you can even get results for only some languages, using the languages parameter:
-# https://www.wikidata.org/w/api.php?action=wbgetentities&ids=Q775450|Q3041294|Q646968|Q434841|Q11920&format=json&props=labels&languages=en|de|fr
-# """
 
-def get_topics_from_wkdt_search_tool(url: str, api_url: str, query: str, lang: str, limit: int = 10) -> Dict[str, str]:
+def get_search_backend(name: str = DEFAULT_SEARCH_BACKEND, index_path: str = DEFAULT_INDEX_PATH) -> SearchBackend:
+    """
+    Returns the search backend registered under `name`. The online backends but the scraper fall back to the scraper,
+    the offline backend reads the index at `index_path`.
+    """
+    if name not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown search backend \"{name}\", choose one of {sorted(SEARCH_BACKENDS)}.")
+    if name == OfflineSearchBackend.name:
+        return OfflineSearchBackend(index_path)
+    if name == HTMLSearchBackend.name:
+        return HTMLSearchBackend()
+    return SEARCH_BACKENDS[name](fallback=HTMLSearchBackend())
+
+
+def get_topics_from_wkdt_search_tool(url: str, api_url: str, query: str, lang: str, limit: int = 10, backend: Optional[SearchBackend] = None,
+                                     raise_errors: bool = False) -> Dict[str, str]:
     """
     Retrieves instances from the Wikidata search tool based on a given query, and then finds the related topics for each instance.
 
@@ -72,42 +267,32 @@ def get_topics_from_wkdt_search_tool(url: str, api_url: str, query: str, lang: s
         query (str): The search query to retrieve instances.
         lang (str): The language code for the labels of the retrieved instances.
         limit (int, optional): The maximum number of instances to retrieve. Default is 500.
+        backend (SearchBackend, optional): The search backend. Default is the JSON search API, falling back to scraping the search tool.
+        raise_errors (bool, optional): Whether a failed search raises after it is logged, instead of returning the topics
+            found so far. Default is False.
 
     Returns:
         dict: A dictionary containing the retrieved topics as keys and their corresponding entity IDs as values.
     """
     wikidata_topics = {}
-    params = {
-        "title": "Special:Search",
-        "limit": limit,
-        "offset": 0,
-        "ns0": 1,
-        "ns120": 1,
-        "search": query
-    }
+    if backend is None:
+        backend = APISearchBackend(api_url, fallback=HTMLSearchBackend(url, api_url))
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()  # Raises an HTTPError if the response status code is 4XX or 5XX
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.content, "html.parser")
-            # Find all search result items
-            search_results = soup.find_all("div", class_="mw-search-result-heading")
-            # Extract IDs from search results
-            retrieved_ids = [result.find("a").get("href").split("/")[-1] for result in search_results if result.find("a")]
-            for page_id in retrieved_ids:
-                for topic, entity_id in get_instances_by_property_P31(api_url, page_id, lang):
-                    if topic not in wikidata_topics:
-                        wikidata_topics[topic] = entity_id
-            return wikidata_topics 
-
-        logging.error(f"Failed to retrieve data for query \"{query}\". Status code: {response.status_code}")
+        retrieved_ids = backend.search(query, lang, limit)
+        for topic, entity_id in backend.resolve_topics(retrieved_ids, lang):
+            if topic not in wikidata_topics:
+                wikidata_topics[topic] = entity_id
         return wikidata_topics
 
     except requests.exceptions.RequestException as e:
         logging.error(f"Request failed: {e}")
+        if raise_errors:
+            raise
         return wikidata_topics
     except Exception as e:
         logging.error(f"Error from query \"{query}\": {e}")
+        if raise_errors:
+            raise
         return wikidata_topics
 
 
@@ -0,0 +1,165 @@
+import numpy as np
+import spacy
+from typing import List, Dict, Iterable, Optional, Tuple
+from spacy.tokens import Doc
+
+
+def embed_texts(model: spacy.Language, texts: Iterable[str], batch_size: int = 1000) -> np.ndarray:
+    """
+    Converts each text to its spaCy document vector.
+    Texts without a vector (or without tokens) get a row of NaN, which the engine scores as -inf,
+    so such topics never match a label.
+
+    Only the tokenizer runs: with a plain vectors table the mean of the token vectors (`Doc.vector`) is computed
+    directly from the table, otherwise (e.g. floret vectors) the texts go through `model.pipe`.
+
+    Args:
+        model (spacy.Language): A pre-trained spaCy model.
+        texts (Iterable[str]): The texts to embed.
+        batch_size (int): The number of texts tokenized at once.
+
+    Returns:
+        np.ndarray: A float32 matrix of shape (len(texts), vectors_length).
+    """
+    texts = list(texts)
+    vectors = model.vocab.vectors
+    if getattr(vectors, "mode", "default") != "default" or vectors.size == 0:
+        return docs_to_matrix(list(model.pipe(texts, batch_size=batch_size)), model.vocab.vectors_length)
+
+    table = vectors.data
+    matrix = np.full((len(texts), model.vocab.vectors_length), np.nan, dtype=np.float32)
+    for i, doc in enumerate(model.tokenizer.pipe(texts, batch_size=batch_size)):
+        if len(doc) == 0:
+            continue
+        rows = np.asarray(vectors.find(keys=[token.orth for token in doc]))
+        known = rows >= 0
+        if not known.any():
+            continue
+        token_vectors = np.zeros((len(doc), matrix.shape[1]), dtype=np.float32)
+        token_vectors[known] = table[rows[known]]
+        # summed token by token like `Doc.vector`, so the vectors are bit-identical
+        matrix[i] = np.cumsum(token_vectors, axis=0)[-1] / len(doc)
+    return matrix
+
+
+def docs_to_matrix(docs: List[Doc], dim: int) -> np.ndarray:
+    """
+    Stacks the vectors of the given docs into one float32 matrix, NaN rows for docs without a vector.
+    """
+    matrix = np.full((len(docs), dim), np.nan, dtype=np.float32)
+    for i, doc in enumerate(docs):
+        if doc.has_vector and len(doc) > 0:
+            matrix[i] = doc.vector
+    return matrix
+
+
+class LabelSimilarityEngine:
+    """
+    Holds the normalized label-synonym vectors of every label in one matrix, so that a batch of topic vectors
+    is scored against all labels with a single matrix multiply.
+
+    The scores are the cosine similarities `Doc.similarity` would return: a synonym with a zero vector scores 0.0,
+    a topic whose text equals a synonym scores exactly 1.0 and a topic without a vector scores -inf.
+    """
+
+    def __init__(self, label_doc_dict: Dict[str, List[Doc]]):
+        """
+        Args:
+            label_doc_dict (Dict[str, List[Doc]]): The output of `get_label_synonyms2vecs`.
+        """
+        self.labels: List[str] = list(label_doc_dict.keys())
+        self.synonyms: Dict[str, List[str]] = {}
+        vectors = []
+        offsets = [0]
+        for label in self.labels:
+            docs = [doc for doc in label_doc_dict[label] if doc.has_vector and len(doc) > 0]
+            self.synonyms[label] = [doc.text for doc in docs]
+            vectors.extend(doc.vector for doc in docs)
+            offsets.append(offsets[-1] + len(docs))
+        self.dim = len(vectors[0]) if vectors else 0
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.dim))
+        self._synonym_index = [_first_index(self.synonyms[label]) for label in self.labels]
+
+    @classmethod
+    def from_matrix(cls, labels: List[str], synonyms: Dict[str, List[str]], offsets: np.ndarray, matrix: np.ndarray) -> "LabelSimilarityEngine":
+        """
+        Rebuilds an engine from the attributes of another one without spaCy docs, e.g. in a worker process
+        around a label matrix in shared memory (the matrix is used as is, not copied).
+        """
+        engine = cls.__new__(cls)
+        engine.labels = list(labels)
+        engine.synonyms = synonyms
+        engine.dim = matrix.shape[1]
+        engine.offsets = np.asarray(offsets, dtype=np.int64)
+        engine.matrix = matrix
+        engine._synonym_index = [_first_index(synonyms[label]) for label in engine.labels]
+        return engine
+
+    def score(self, topic_vectors: np.ndarray, topic_texts: Optional[List[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scores a batch of topic vectors against every label.
+
+        Args:
+            topic_vectors (np.ndarray): Matrix of shape (n_topics, dim), NaN rows for topics without a vector.
+            topic_texts (List[str], optional): The topic strings, used to give exact synonym matches a similarity of 1.0.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The per-label maximum similarity and the index of the most similar synonym
+                (into `self.synonyms[label]`), both of shape (n_topics, n_labels). Labels without synonyms and topics
+                without a vector get -inf and -1.
+        """
+        n_topics = topic_vectors.shape[0]
+        max_sims = np.full((n_topics, len(self.labels)), -np.inf, dtype=np.float32)
+        argmax = np.full((n_topics, len(self.labels)), -1, dtype=np.int64)
+        if n_topics == 0 or self.matrix.shape[0] == 0:
+            return max_sims, argmax
+
+        has_vector = ~np.isnan(topic_vectors).any(axis=1)
+        sims = _normalize_rows(np.nan_to_num(topic_vectors.astype(np.float32, copy=False))) @ self.matrix.T
+        if topic_texts is not None:
+            for j in range(len(self.labels)):
+                start = self.offsets[j]
+                for i, text in enumerate(topic_texts):
+                    k = self._synonym_index[j].get(text)
+                    if k is not None:
+                        sims[i, start + k] = 1.0
+        sims[~has_vector] = -np.inf
+
+        for j in range(len(self.labels)):
+            start, end = self.offsets[j], self.offsets[j + 1]
+            if start == end:
+                continue
+            block = sims[:, start:end]
+            argmax[:, j] = block.argmax(axis=1)
+            max_sims[:, j] = block[np.arange(n_topics), argmax[:, j]]
+        argmax[~has_vector] = -1
+        return max_sims, argmax
+
+    def entity_scores(self, topic_vectors: np.ndarray, topic_texts: Optional[List[str]] = None) -> np.ndarray:
+        """
+        Returns the maximum similarity of any of the entity's topics to each label, shape (n_labels,).
+        """
+        max_sims, _ = self.score(topic_vectors, topic_texts)
+        if max_sims.shape[0] == 0:
+            return np.full(len(self.labels), -np.inf, dtype=np.float32)
+        return max_sims.max(axis=0)
+
+
+def _first_index(texts: List[str]) -> Dict[str, int]:
+    """
+    Maps each text to the position of its first occurrence in `texts`.
+    """
+    index: Dict[str, int] = {}
+    for i, text in enumerate(texts):
+        index.setdefault(text, i)
+    return index
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scales every row to unit length, rows with a zero norm are left as zeros (similarity 0.0, as in spaCy).
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
@@ -0,0 +1,199 @@
+import argparse
+import os
+import sqlite3
+import numpy as np
+from typing import Iterable, List, Optional, Tuple
+from wikidata_dump_index import DEFAULT_INDEX_PATH
+
+DEFAULT_CLOSURE_PATH = "cache/subclass_closure.npz"
+
+
+def qid_to_int(qid: str) -> int:
+    return int(qid.strip().lstrip('Q'))
+
+
+def _csr(sources: np.ndarray, targets: np.ndarray, n_rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Builds a compressed sparse row adjacency (indptr, indices) from an edge list, targets of a row sorted.
+    """
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n_rows), out=indptr[1:])
+    return indptr, targets[order]
+
+
+def _csr_rows(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Returns the concatenated neighbours of the given rows without a Python loop.
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    if lengths.sum() == 0:
+        return indices[:0]
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return indices[offsets]
+
+
+def read_edges_from_index(index_path: str, prop: int, batch_size: int = 1_000_000) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads the (subject, value) pairs of property `prop` (31 or 279) from the offline index as QID numbers.
+    """
+    conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    cursor = conn.execute("SELECT qid, target FROM claims WHERE prop = ?", (prop,))
+    blocks = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        blocks.append(np.asarray(rows, dtype=np.int64))
+    conn.close()
+    edges = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.int64)
+    return edges[:, 0], edges[:, 1]
+
+
+def read_edges_from_tsv(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads cached edges, one `subject<TAB>value` pair of QIDs per line (e.g. exported from WDQS).
+    """
+    subjects, values = [], []
+    with open(path, 'r', encoding='utf-8') as reader:
+        for line in reader:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].startswith('Q') and fields[1].startswith('Q'):
+                subjects.append(qid_to_int(fields[0]))
+                values.append(qid_to_int(fields[1]))
+    return np.asarray(subjects, dtype=np.int64), np.asarray(values, dtype=np.int64)
+
+
+class SubclassClosure:
+    """
+    P279 ("subclass of") hierarchy and P31 ("instance of") members in compressed sparse row form.
+
+    Classes are numbered by their position in the sorted `class_ids` array; `sub_indptr`/`sub_indices` map a class
+    to its direct subclasses and `inst_indptr`/`inst_items` map a class to the QID numbers of its direct instances.
+    The descendant sets of the taxonomy roots are precomputed as bitsets over the classes, so
+    "all items whose P31 is under Q12136" is a bitset lookup followed by a union of CSR rows.
+    """
+
+    def __init__(self, class_ids: np.ndarray, sub_indptr: np.ndarray, sub_indices: np.ndarray,
+                 inst_indptr: np.ndarray, inst_items: np.ndarray,
+                 root_ids: Optional[np.ndarray] = None, root_bitsets: Optional[np.ndarray] = None):
+        self.class_ids = class_ids
+        self.sub_indptr = sub_indptr
+        self.sub_indices = sub_indices
+        self.inst_indptr = inst_indptr
+        self.inst_items = inst_items
+        self.root_ids = root_ids if root_ids is not None else np.zeros(0, dtype=np.int64)
+        self.root_bitsets = root_bitsets if root_bitsets is not None else np.zeros((0, (len(class_ids) + 7) // 8), dtype=np.uint8)
+
+    @classmethod
+    def from_edges(cls, subclass_edges: Tuple[np.ndarray, np.ndarray], instance_edges: Tuple[np.ndarray, np.ndarray]) -> "SubclassClosure":
+        """
+        Builds the closure from (child, parent) P279 edges and (item, class) P31 edges, given as QID numbers.
+        """
+        children, parents = subclass_edges
+        items, classes = instance_edges
+        class_ids = np.unique(np.concatenate([children, parents, classes]))
+        sub_indptr, sub_indices = _csr(np.searchsorted(class_ids, parents), np.searchsorted(class_ids, children), len(class_ids))
+        inst_indptr, inst_items = _csr(np.searchsorted(class_ids, classes), items, len(class_ids))
+        return cls(class_ids, sub_indptr, sub_indices.astype(np.int32), inst_indptr, inst_items)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_CLOSURE_PATH) -> "SubclassClosure":
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def save(self, path: str = DEFAULT_CLOSURE_PATH) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, class_ids=self.class_ids, sub_indptr=self.sub_indptr, sub_indices=self.sub_indices,
+                            inst_indptr=self.inst_indptr, inst_items=self.inst_items,
+                            root_ids=self.root_ids, root_bitsets=self.root_bitsets)
+        os.replace(tmp_path, path)
+
+    def _class_index(self, qid: str) -> Optional[int]:
+        number = qid_to_int(qid)
+        position = int(np.searchsorted(self.class_ids, number))
+        if position < len(self.class_ids) and self.class_ids[position] == number:
+            return position
+        return None
+
+    def _descendant_mask(self, position: int) -> np.ndarray:
+        """
+        Returns a boolean mask over the classes: the class itself and all its transitive subclasses.
+        """
+        root = np.searchsorted(self.root_ids, self.class_ids[position])
+        if root < len(self.root_ids) and self.root_ids[root] == self.class_ids[position]:
+            return np.unpackbits(self.root_bitsets[root], count=len(self.class_ids)).astype(bool)
+        mask = np.zeros(len(self.class_ids), dtype=bool)
+        mask[position] = True
+        frontier = np.asarray([position], dtype=np.int64)
+        while len(frontier):
+            children = _csr_rows(self.sub_indptr, self.sub_indices, frontier)
+            frontier = np.unique(children[~mask[children]]).astype(np.int64)
+            mask[frontier] = True
+        return mask
+
+    def precompute(self, root_qids: Iterable[str]) -> None:
+        """
+        Stores the descendant bitsets of the given classes, so later lookups of them need no traversal.
+        """
+        roots = sorted({qid_to_int(qid) for qid in root_qids if self._class_index(qid) is not None})
+        self.root_ids = np.zeros(0, dtype=np.int64)
+        bitsets = [np.packbits(self._descendant_mask(self._class_index(f"Q{root}"))) for root in roots]
+        self.root_ids = np.asarray(roots, dtype=np.int64)
+        self.root_bitsets = np.asarray(bitsets, dtype=np.uint8).reshape(len(roots), (len(self.class_ids) + 7) // 8)
+
+    def descendants(self, qid: str) -> List[str]:
+        """
+        Returns the class and all its transitive subclasses (`wdt:P279*`).
+        """
+        position = self._class_index(qid)
+        if position is None:
+            return [qid]
+        return [f"Q{number}" for number in self.class_ids[self._descendant_mask(position)]]
+
+    def instance_numbers(self, qid: str) -> np.ndarray:
+        """
+        Returns the sorted QID numbers of the items whose P31 is the class or one of its subclasses
+        (`?item wdt:P31/wdt:P279* wd:<qid>`).
+        """
+        position = self._class_index(qid)
+        if position is None:
+            return np.zeros(0, dtype=np.int64)
+        classes = np.flatnonzero(self._descendant_mask(position))
+        return np.unique(_csr_rows(self.inst_indptr, self.inst_items, classes))
+
+    def instances_of(self, qid: str) -> List[str]:
+        return [f"Q{number}" for number in self.instance_numbers(qid)]
+
+
+def read_taxonomy_qids(taxonomy_root: str) -> List[str]:
+    """
+    Returns the QIDs listed in the `name | QID` files under `taxonomy_root` (e.g. `label_taxonomy/`).
+    """
+    qids = []
+    for directory, _, filenames in os.walk(taxonomy_root):
+        for filename in filenames:
+            if filename.endswith(".txt"):
+                with open(os.path.join(directory, filename), 'r', encoding='utf-8') as reader:
+                    qids.extend(line.split()[-1] for line in reader if line.strip())
+    return qids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the P279 subclass closure index.', add_help=False)
+    parser.add_argument('--index', type=str, help='Offline Wikidata index to read the P31/P279 edges from.', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--subclass_edges', type=str, help='TSV of cached `child parent` P279 edges, instead of the index.', default=None)
+    parser.add_argument('--instance_edges', type=str, help='TSV of cached `item class` P31 edges, instead of the index.', default=None)
+    parser.add_argument('--taxonomy', type=str, help='Directory of taxonomy files whose QIDs get precomputed descendant sets.', default="label_taxonomy")
+    parser.add_argument('--out', type=str, help='Path of the closure to write.', default=DEFAULT_CLOSURE_PATH)
+    sg = parser.parse_args()
+
+    subclass_edges = read_edges_from_tsv(sg.subclass_edges) if sg.subclass_edges else read_edges_from_index(sg.index, 279)
+    instance_edges = read_edges_from_tsv(sg.instance_edges) if sg.instance_edges else read_edges_from_index(sg.index, 31)
+    closure = SubclassClosure.from_edges(subclass_edges, instance_edges)
+    closure.precompute(read_taxonomy_qids(sg.taxonomy))
+    closure.save(sg.out)
+    print(f"{len(closure.class_ids)} classes, {len(closure.sub_indices)} subclass edges, {len(closure.inst_items)} instance edges, {len(closure.root_ids)} precomputed roots")
@@ -0,0 +1,13 @@
+import pytest
+
+from entity_scores import parse_thresholds
+
+
+def test_parse_thresholds_expands_ranges():
+    assert parse_thresholds(["0.5:0.6:0.05", "0.9", "0.55"]) == [0.5, 0.55, 0.6, 0.9]
+
+
+@pytest.mark.parametrize("value", ["0.5:0.9:0", "0.5:0.9:-0.1", "0.9:0.5:0.1", "0.5:0.9", "0.5:x:0.1"])
+def test_parse_thresholds_rejects_bad_ranges(value):
+    with pytest.raises(ValueError):
+        parse_thresholds([value])
@@ -0,0 +1,26 @@
+from gazetteer_writer import GazetteerWriter
+
+
+def test_rerun_replaces_the_whole_gazetteer(tmp_path):
+    with GazetteerWriter(str(tmp_path)) as writer:
+        writer.add("A", "x")
+        writer.add("B", "y")
+    (tmp_path / "coverage.txt").write_text("A 1\n", encoding="utf-8")
+
+    with GazetteerWriter(str(tmp_path), sort=True, other_files=["coverage.txt"]) as writer:
+        writer.add_many("B", ["z", "y", "z"])
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["B.txt", "coverage.txt"]
+    assert (tmp_path / "B.txt").read_text(encoding="utf-8") == "y\nz\n"
+
+
+def test_failed_run_keeps_the_previous_gazetteer(tmp_path):
+    with GazetteerWriter(str(tmp_path)) as writer:
+        writer.add("A", "x")
+    try:
+        with GazetteerWriter(str(tmp_path)) as writer:
+            writer.add("B", "y")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["A.txt"]
@@ -0,0 +1,14 @@
+from ner_store import NERStore, write_ner_store
+
+
+def test_lookup_by_entity_and_by_doc_id(tmp_path):
+    path = str(tmp_path / "data_ners.sqlite")
+    results = [("barack obama", {'txt_id_list': ["1"], 'wiki_topics': {"human": "Q5"}, 'tag': "PER"}),
+               ("paris", {'txt_id_list': ["1", "2"], 'wiki_topics': {}, 'tag': "LOC"})]
+    write_ner_store(path, results, [("1", ["barack obama", "paris"]), ("2", ["paris"])])
+
+    store = NERStore(path)
+    assert store.get("paris") == results[1][1]
+    assert store.get("london") is None
+    assert store.get_doc("1") == ["barack obama", "paris"]
+    assert store.get_doc("3", []) == []
@@ -0,0 +1,33 @@
+import nltk.tokenize
+import pytest
+from nltk.tokenize.punkt import PunktSentenceTokenizer
+
+from datasets.process_rdrs import SpanMapper, get_pos_span
+
+
+@pytest.fixture(autouse=True)
+def punkt(monkeypatch):
+    # an untrained Punkt model, so the tests do not need the punkt data package
+    tokenizer = PunktSentenceTokenizer()
+    monkeypatch.setattr(nltk.tokenize, "_get_punkt_tokenizer", lambda language="english": tokenizer)
+
+
+@pytest.mark.parametrize("text", [
+    "See b. A.) took the pills.",
+    "Met him at St. Paul. The headache went away, and I felt fine.",
+    "Took 2 mg of aspirin (e.g. in the morning) etc. Then the pain went away!",
+    "He said \"gonna\" and John's dose was cannot\nbe taken.",
+])
+def test_span_mapper_matches_get_pos_span(text):
+    mapper = SpanMapper(text)
+    assert mapper.words == nltk.tokenize.word_tokenize(text)
+    for begin in range(len(text)):
+        for end in (begin + 1, len(text)):
+            assert mapper.get_pos_span(begin, end) == get_pos_span(text, begin, end), (begin, end)
+
+
+def test_span_starting_at_the_period_after_an_abbreviation():
+    text = "See b. A.) took the pills."
+    begin = text.index(".)")
+    # truncating the text before the period moves the sentence boundary Punkt finds
+    assert SpanMapper(text).get_pos_span(begin, begin + 2) == get_pos_span(text, begin, begin + 2)
@@ -0,0 +1,56 @@
+import multiprocessing
+
+import numpy as np
+
+from topic_vectors import TopicVectorStore
+
+
+def fake_embed(labels):
+    return np.array([[len(label), sum(map(ord, label)) % 97, 1.0] for label in labels], dtype=np.float32)
+
+
+def save_topics(root, worker, rounds):
+    for round_ in range(rounds):
+        store = TopicVectorStore(root, "model")
+        keys = [(f"Q{worker}_{round_}_{i}", f"label {worker} {round_} {i}") for i in range(20)]
+        keys.append(("Q0", "shared label"))
+        store.lookup(keys, fake_embed)
+        store.save()
+
+
+def test_concurrent_saves_merge_consistently(tmp_path):
+    root, workers, rounds = str(tmp_path), 4, 5
+    processes = [multiprocessing.Process(target=save_topics, args=(root, worker, rounds)) for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    store = TopicVectorStore(root, "model")
+    expected = [(f"Q{worker}_{round_}_{i}", f"label {worker} {round_} {i}")
+                for worker in range(workers) for round_ in range(rounds) for i in range(20)] + [("Q0", "shared label")]
+    assert len(store) == len(expected)
+
+    def fail(labels):
+        raise AssertionError(f"{len(labels)} topics missing from the store")
+
+    vectors = store.lookup(expected, fail)
+    np.testing.assert_array_equal(vectors, fake_embed([label for _, label in expected]))
+    # only the current matrix is left next to the manifest
+    assert sorted(path.name for path in tmp_path.joinpath("model").glob("vectors.*.npy")) == [store._read_saved()[1].filename.rsplit("/", 1)[1]]
+
+
+def test_reads_a_store_saved_before_the_manifest(tmp_path):
+    directory = tmp_path / "model"
+    directory.mkdir()
+    np.save(directory / "vectors.npy", fake_embed(["a", "bb"]))
+    (directory / "index.json").write_text('{"model": "model", "dim": 3, "keys": [["Q1", "a"], ["Q2", "bb"]]}', encoding="utf-8")
+
+    store = TopicVectorStore(str(tmp_path), "model")
+    store.lookup([("Q3", "ccc")], fake_embed)
+    store.save()
+
+    reloaded = TopicVectorStore(str(tmp_path), "model")
+    np.testing.assert_array_equal(reloaded.lookup([("Q1", "a"), ("Q3", "ccc")], fake_embed), fake_embed(["a", "ccc"]))
+    assert not (directory / "vectors.npy").exists()
@@ -0,0 +1,67 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import wiki_http
+
+BODY = "?item\t?itemLabel\n<http://www.wikidata.org/entity/Q1>\t\"café\"@en\r\n<http://www.wikidata.org/entity/Q2>\t\"b\"@en\n".encode("utf-8")
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = 0
+    truncate = False
+    api_error = False
+
+    def do_GET(self):
+        Handler.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/tab-separated-values")
+        if Handler.api_error:
+            self.send_header("MediaWiki-API-Error", "internal_api_error_DBQueryTimeoutError")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY[:len(BODY) // 2] if Handler.truncate else BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    Handler.requests, Handler.truncate, Handler.api_error = 0, False, False
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    wiki_http.configure(rate=1000, cache_path=str(tmp_path / "cache.sqlite"))
+    yield f"http://127.0.0.1:{httpd.server_port}/sparql"
+    httpd.shutdown()
+    wiki_http.configure(cache_path="")
+
+
+def read(url):
+    response = wiki_http.get(url, params={"query": "q"}, stream=True)
+    with response:
+        return list(wiki_http.iter_lines(response, chunk_size=7))
+
+
+def test_streamed_body_is_cached_once_read(server):
+    lines = read(server)
+    assert lines == ["?item\t?itemLabel", "<http://www.wikidata.org/entity/Q1>\t\"café\"@en", "<http://www.wikidata.org/entity/Q2>\t\"b\"@en"]
+    assert read(server) == lines
+    assert Handler.requests == 1
+
+
+def test_incomplete_body_is_not_cached(server):
+    Handler.truncate = True
+    with pytest.raises(Exception):
+        read(server)
+    Handler.truncate = False
+    read(server)
+    assert Handler.requests == 2
+
+
+def test_api_error_is_not_cached(server):
+    Handler.api_error = True
+    wiki_http.get(server, params={"query": "q"}).content
+    wiki_http.get(server, params={"query": "q"}).content
+    assert Handler.requests == 2
@@ -0,0 +1,185 @@
+import fcntl
+import functools
+import json
+import os
+import tempfile
+import numpy as np
+import spacy
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from similarity import embed_texts
+
+# (wikidata QID, topic label)
+TopicKey = Tuple[str, str]
+
+
+# components never used to compare vectors: only the tokenizer and the vectors table are loaded
+UNUSED_COMPONENTS = ["tok2vec", "transformer", "tagger", "morphologizer", "parser", "senter", "sentencizer", "attribute_ruler",
+                     "lemmatizer", "trainable_lemmatizer", "ner", "entity_ruler", "entity_linker", "textcat", "textcat_multilabel", "spancat"]
+
+
+def get_model_name(model: Union[spacy.Language, str]) -> str:
+    """
+    Returns the name that identifies the vectors of a spaCy model, e.g. `en_core_web_lg-3.7.1`.
+    A model given by its package name or path is not loaded, only its version or meta.json is read.
+    """
+    if isinstance(model, str):
+        if not os.path.isdir(model):
+            return f"{model}-{spacy.util.get_package_version(model) or '0.0.0'}"
+        meta = spacy.util.load_meta(os.path.join(model, "meta.json"))
+    else:
+        meta = model.meta
+    return f"{meta.get('lang', 'xx')}_{meta.get('name', 'model')}-{meta.get('version', '0.0.0')}"
+
+
+@functools.lru_cache(maxsize=None)
+def load_vectors_model(name: str) -> spacy.Language:
+    """
+    Loads a spaCy model (package name or path) with its tokenizer and vectors only, once per process.
+    """
+    return spacy.load(name, exclude=UNUSED_COMPONENTS)
+
+
+def resolve_model(model: Union[spacy.Language, str]) -> spacy.Language:
+    """
+    Returns the model itself, or loads it (vectors only) when it is given by name, so callers can defer loading until
+    vectors are actually needed.
+    """
+    return load_vectors_model(model) if isinstance(model, str) else model
+
+
+class TopicVectorStore:
+    """
+    Persistent store of topic vectors keyed by (QID, label, model name).
+
+    Every model gets its own directory under `root` holding a matrix `vectors.<version>.npy` (one float32 row per
+    topic, memory-mapped when read) and `index.json`, the manifest naming the current matrix with the list of
+    [QID, label] keys in row order. Topics without a vector are stored as a row of NaN so they are not embedded again
+    either. Several processes may share a store (e.g. the shards of a build): `save()` merges the topics saved by the
+    others since this store was read.
+    """
+
+    def __init__(self, root: str, model_name: str):
+        self.directory = os.path.join(root, model_name)
+        self.model_name = model_name
+        self._index_path = os.path.join(self.directory, "index.json")
+        self._lock_path = os.path.join(self.directory, ".lock")
+        self._keys: List[TopicKey] = []
+        self._rows: Dict[TopicKey, int] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._dirty = False
+        saved = self._read_saved()
+        if saved is not None:
+            self._keys, self._vectors = saved
+            self._rows = {key: row for row, key in enumerate(self._keys)}
+
+    def _read_saved(self) -> Optional[Tuple[List[TopicKey], np.ndarray]]:
+        """
+        Reads the keys and the memory-mapped matrix of the current version on disk, or None without one.
+        """
+        missing = None
+        while True:
+            try:
+                with open(self._index_path, 'r', encoding='utf-8') as file:
+                    index = json.load(file)
+            except FileNotFoundError:
+                return None
+            # stores written before the manifest named its matrix have a single `vectors.npy`
+            vectors_path = os.path.join(self.directory, index.get("vectors", "vectors.npy"))
+            try:
+                vectors = np.load(vectors_path, mmap_mode='r')
+            except FileNotFoundError:
+                if vectors_path == missing:
+                    raise
+                # the matrix was replaced by a newer version between reading the manifest and opening it
+                missing = vectors_path
+                continue
+            return [tuple(key) for key in index["keys"]][:vectors.shape[0]], vectors
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: TopicKey) -> bool:
+        return key in self._rows
+
+    def lookup(self, keys: List[TopicKey], embed: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Returns the vectors of the given topics, shape (len(keys), dim).
+        Only topics missing from the store are passed (by label) to `embed`; they are added to the store
+        and persisted on the next `save()`.
+
+        Args:
+            keys (List[TopicKey]): The (QID, label) pairs to look up.
+            embed (Callable[[List[str]], np.ndarray]): Embeds a list of topic labels, e.g. `similarity.embed_texts`.
+
+        Returns:
+            np.ndarray: The float32 topic vectors in the order of `keys`.
+        """
+        misses = list(dict.fromkeys(key for key in keys if key not in self._rows))
+        if misses:
+            new_vectors = np.asarray(embed([label for _, label in misses]), dtype=np.float32)
+            for key in misses:
+                self._rows[key] = len(self._keys)
+                self._keys.append(key)
+            self._vectors = new_vectors if self._vectors is None else np.concatenate([self._vectors, new_vectors], axis=0)
+            self._dirty = True
+        if self._vectors is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._vectors[[self._rows[key] for key in keys]]
+
+    def save(self) -> None:
+        """
+        Writes the store to disk as a new version, so readers never see a half written matrix or a matrix with the
+        keys of another one.
+
+        Under an exclusive lock of the directory, the topics saved meanwhile by other processes are read back and
+        merged with the ones added here. The matrix is written to a new uniquely named file, then the manifest
+        naming it replaces `index.json` in one rename, and the previous matrix is removed.
+        """
+        if not self._dirty:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                saved = self._read_saved()
+                keys, vectors = saved if saved is not None else ([], None)
+                saved_rows = dict.fromkeys(keys)
+                added = [row for row, key in enumerate(self._keys) if key not in saved_rows]
+                keys = keys + [self._keys[row] for row in added]
+                matrix = np.asarray(self._vectors[added], dtype=np.float32)
+                if vectors is not None:
+                    matrix = np.concatenate([vectors, matrix], axis=0)
+                previous_vectors = getattr(vectors, "filename", None)
+
+                fd, vectors_path = tempfile.mkstemp(prefix="vectors.", suffix=".npy", dir=self.directory)
+                with os.fdopen(fd, 'wb') as file:
+                    np.save(file, np.ascontiguousarray(matrix))
+                fd, tmp_index_path = tempfile.mkstemp(prefix="index.", suffix=".json.tmp", dir=self.directory)
+                with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                    json.dump({"model": self.model_name, "dim": int(matrix.shape[1]), "vectors": os.path.basename(vectors_path),
+                               "keys": keys}, file, ensure_ascii=False)
+                os.replace(tmp_index_path, self._index_path)
+                if previous_vectors is not None:
+                    os.remove(previous_vectors)
+                # mapped before another process may replace and remove it
+                self._vectors = np.load(vectors_path, mmap_mode='r')
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._keys = keys
+        self._rows = {key: row for row, key in enumerate(keys)}
+        self._dirty = False
+
+
+def embed_topics(model: Union[spacy.Language, str], keys: List[TopicKey], store: Optional[TopicVectorStore] = None) -> np.ndarray:
+    """
+    Embeds the given (QID, label) topics, reading and updating the persistent store when one is given.
+    A model given by name is only loaded when some topic is missing from the store.
+    """
+    def embed(texts: List[str]) -> np.ndarray:
+        return embed_texts(resolve_model(model), texts)
+
+    if store is None:
+        return embed([label for _, label in keys])
+    vectors = store.lookup(keys, embed)
+    store.save()
+    return vectors
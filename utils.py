@@ -5,7 +5,22 @@ def parse_args():
     p = argparse.ArgumentParser(description='Make gazetteer configuration.', add_help=False)
     p.add_argument('--data', type=str, help='Path to the train data.', default=None)
     p.add_argument('--threshold', type=float, help='Threshold for similarity.', default=0.75)
+    p.add_argument('--thresholds', type=str, nargs='+', help='Sweep: thresholds or ranges start:stop:step, one gazetteer each from one similarity pass.', default=None)
     p.add_argument('--limit', type=int, help='Number of pages used to get topics for each entity.', default=3)
     p.add_argument('--lang', type=str, help='Language used for searching.', default="en")
+    p.add_argument('--search_backend', type=str, help='Wikidata search backend: api, entities, html or offline.', default="api")
+    p.add_argument('--wikidata_index', type=str, help='Offline Wikidata index used by the offline search backend.', default="cache/wikidata_index.sqlite")
+    p.add_argument('--workers', type=int, help='Number of concurrent Wikidata searches.', default=4)
+    p.add_argument('--rate', type=float, help='Maximum number of Wikidata requests per second.', default=5)
+    p.add_argument('--http_cache', type=str, help='SQLite file caching Wikidata responses, empty to disable.', default="cache/wikidata_http.sqlite")
+    p.add_argument('--http_cache_ttl', type=float, help='Days a cached Wikidata response stays valid.', default=30)
+    p.add_argument('--qid_fast_path', action='store_true', help='Assign entities whose topic QIDs are listed in label_taxonomy/ without vector similarity.')
+    p.add_argument('--closure', type=str, help='Subclass closure expanding the taxonomy QIDs of --qid_fast_path.', default=None)
+    p.add_argument('--sort_gazetteers', action='store_true', help='Write the gazetteer files sorted instead of in corpus order.')
+    p.add_argument('--processes', type=int, help='Number of processes scoring the entities and writing the gazetteers of the folds (rdrs).', default=1)
+    p.add_argument('--spacy_model', type=str, help='spaCy model (package name or path) providing the word vectors.', default="en_core_web_lg")
+    p.add_argument('--shard', type=str, help='Sharded build: search and score only shard i/n of the entities, into partial gazetteers.', default=None)
+    p.add_argument('--merge_shards', type=int, help='Merge the partial gazetteers of this many shards into the gazetteers (no search or scoring).', default=0)
+    p.add_argument('--topic_cache', type=str, help='Directory of the persistent topic vector store.', default="cache/topic_vectors")
 
     return p.parse_args()
\ No newline at end of file
@@ -0,0 +1,196 @@
+import email.utils
+import logging
+import tempfile
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, Generator, Optional
+from http_cache import DEFAULT_TTL, ResponseCache, make_key
+
+USER_AGENT = "gazetteer_creator/1.0 (https://github.com/andrew6072/gazetteer_creator) python-requests"
+# seconds of replication lag after which the Wikidata API asks us to back off, see https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+MAXLAG = 5
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `acquire()` blocks until a token is available, tokens refill at `rate` per second
+    up to `capacity`. `pause()` stops handing out tokens to every thread for a while, e.g. after HTTP 429.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0
+            self._last = self._paused_until
+
+
+_bucket = TokenBucket(rate=5)
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_pool_size = 10
+_cache: Optional[ResponseCache] = None
+
+
+def configure(rate: Optional[float] = None, pool_size: Optional[int] = None, cache_path: Optional[str] = None, cache_ttl: float = DEFAULT_TTL) -> None:
+    """
+    Sets the shared request rate (requests per second over all threads), the connection pool size of the shared session
+    and the SQLite response cache (an empty `cache_path` turns the cache off).
+    """
+    global _bucket, _session, _pool_size, _cache
+    if rate is not None:
+        _bucket = TokenBucket(rate=rate)
+    if cache_path is not None:
+        _cache = ResponseCache(cache_path, ttl=cache_ttl) if cache_path else None
+    if pool_size is not None:
+        with _session_lock:
+            _pool_size = max(pool_size, 1)
+            _session = None
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the `requests.Session` shared by all threads, so connections to Wikidata are reused.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=_pool_size, pool_maxsize=_pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+            _session = session
+        return _session
+
+
+def _retry_after(response: requests.Response, default: float) -> float:
+    """
+    Reads the `Retry-After` header, which is either a number of seconds or an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return default
+
+
+def _cached_response(url: str, params: Optional[Dict], status: int, content_type: str, body: bytes) -> requests.Response:
+    """
+    Builds a `requests.Response` from a cached body.
+    """
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response._content_consumed = True
+    response.headers["Content-Type"] = content_type
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.url = requests.Request("GET", url, params=params).prepare().url
+    return response
+
+
+def get(url: str, params: Optional[Dict] = None, max_retries: int = 5, timeout: float = 60, use_cache: bool = True, **kwargs) -> requests.Response:
+    """
+    Sends a GET request through the shared session under the shared rate limit.
+    HTTP 429/503 responses and Wikidata API `maxlag` errors pause every thread for `Retry-After` seconds
+    (exponential backoff when the header is missing) and are retried up to `max_retries` times.
+    Successful responses are stored in the response cache (if configured) and answered from it on later runs;
+    a 200 answer carrying a `MediaWiki-API-Error` is not. The whole body is read before it is stored, a download cut
+    short raises instead of being cached. A response requested with `stream=True` is stored once its body was read
+    to the end through `iter_lines`.
+
+    Args:
+        url (str): The URL to request.
+        params (Dict, optional): The query parameters.
+        max_retries (int): How many times a throttled request is retried before its response is returned as is.
+        timeout (float): The request timeout in seconds.
+        use_cache (bool): Whether the response cache may be used for this request.
+
+    Returns:
+        requests.Response: The response.
+    """
+    cache = _cache if use_cache else None
+    if cache is not None:
+        cache_key = make_key(url, params, kwargs.get("headers"))
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return _cached_response(url, params, *cached)
+
+    backoff = 1.0
+    for attempt in range(max_retries + 1):
+        _bucket.acquire()
+        response = get_session().get(url, params=params, timeout=timeout, **kwargs)
+        throttled = response.status_code in (429, 503) or response.headers.get("MediaWiki-API-Error") == "maxlag"
+        if response.status_code == 200 and "MediaWiki-API-Error" not in response.headers and cache is not None:
+            if kwargs.get("stream"):
+                response._cache_entry = (cache_key, url)
+            else:
+                cache.put(cache_key, url, response.status_code, response.headers.get("Content-Type", ""), response.content)
+        if not throttled or attempt == max_retries:
+            return response
+        wait = _retry_after(response, backoff)
+        logging.warning(f"Throttled by {url} (status {response.status_code}), retrying in {wait:.1f}s")
+        # give the connection back to the pool, a streamed response would otherwise hold it
+        response.close()
+        _bucket.pause(wait)
+        backoff = min(backoff * 2, 300)
+    return response
+
+
+def iter_lines(response: requests.Response, chunk_size: int = 1 << 16, spool_size: int = 1 << 24) -> Generator[str, None, None]:
+    """
+    Yields the lines of a UTF-8 response body (without line ends) as it is downloaded, e.g. a SPARQL TSV answer.
+
+    For a response of `get(..., stream=True)` that may be cached, the body is spooled to a temporary file (in memory
+    up to `spool_size` bytes) while it is read, and stored in the response cache only when it was read to the end:
+    an interrupted download is never answered from the cache.
+    """
+    cache_entry = getattr(response, "_cache_entry", None)
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size) if cache_entry is not None and _cache is not None else None
+    try:
+        pending = b""
+        for chunk in response.iter_content(chunk_size):
+            if spool is not None:
+                spool.write(chunk)
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b"\r").decode("utf-8")
+        if pending:
+            yield pending.rstrip(b"\r").decode("utf-8")
+        if spool is not None:
+            spool.seek(0)
+            _cache.put(*cache_entry, response.status_code, response.headers.get("Content-Type", ""), spool.read())
+    finally:
+        if spool is not None:
+            spool.close()
@@ -0,0 +1,212 @@
+import argparse
+import bz2
+import functools
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+from typing import BinaryIO, Dict, Generator, Iterable, List, Optional, Tuple
+from tqdm import tqdm
+
+DEFAULT_INDEX_PATH = "cache/wikidata_index.sqlite"
+# the claims kept in the index: P31 ("instance of") and P279 ("subclass of")
+INDEXED_PROPERTIES = (31, 279)
+
+
+def normalize_label(label: str) -> str:
+    """
+    Normalizes a label or a query for lookups: case-insensitive and ignoring repeated whitespace.
+    """
+    return ' '.join(label.split()).casefold()
+
+
+def open_dump(path: str) -> BinaryIO:
+    """
+    Opens a Wikidata JSON dump, plain or compressed with bz2/gz. `-` reads the (already decompressed) dump from stdin,
+    e.g. `lbzip2 -dc latest-all.json.bz2 | python -m wikidata_dump_index --dump -`.
+    """
+    if path == '-':
+        return sys.stdin.buffer
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_chunks(lines: Iterable[bytes], chunk_size: int) -> Generator[List[bytes], None, None]:
+    """
+    Groups the lines of a dump into lists of `chunk_size` lines, the unit of work of the process pool.
+    """
+    iterator = iter(lines)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_chunk(lines: List[bytes], langs: Tuple[str, ...]) -> Tuple[List[tuple], List[tuple], List[tuple], List[tuple]]:
+    """
+    Parses the entities of a chunk of dump lines. Runs in the worker processes.
+
+    Returns:
+        The rows of the `items`, `labels`, `names` and `claims` tables. Only items (Q ids) are kept,
+        labels and aliases only in `langs`.
+    """
+    items, labels, names, claims = [], [], [], []
+    for line in lines:
+        line = line.strip().rstrip(b',')
+        if not line.startswith(b'{'):
+            continue
+        try:
+            entity = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        entity_id = entity.get('id', '')
+        if not entity_id.startswith('Q'):
+            continue
+        qid = int(entity_id[1:])
+        items.append((qid, len(entity.get('sitelinks', {}))))
+        for lang in langs:
+            label = entity.get('labels', {}).get(lang, {}).get('value')
+            if label:
+                labels.append((qid, lang, label))
+                names.append((normalize_label(label), lang, qid, 0))
+            for alias in entity.get('aliases', {}).get(lang, []):
+                if alias.get('value'):
+                    names.append((normalize_label(alias['value']), lang, qid, 1))
+        for prop in INDEXED_PROPERTIES:
+            for statement in entity.get('claims', {}).get(f"P{prop}", []):
+                target = statement.get('mainsnak', {}).get('datavalue', {}).get('value', {}).get('id', '')
+                if target.startswith('Q'):
+                    claims.append((qid, prop, int(target[1:])))
+    return items, labels, names, claims
+
+
+def build_index(dump_path: str, index_path: str = DEFAULT_INDEX_PATH, langs: Tuple[str, ...] = ("en",), workers: int = os.cpu_count() or 1, chunk_size: int = 2000) -> None:
+    """
+    Streams a Wikidata JSON dump through a process pool and writes the offline index:
+    label/alias -> QIDs, QID -> P31/P279 ids and QID -> labels per language.
+    The index is written to a temporary file and renamed when complete.
+
+    Args:
+        dump_path (str): The path to the dump (`.json`, `.json.bz2`, `.json.gz` or `-` for stdin).
+        index_path (str): The path of the SQLite index to write.
+        langs (Tuple[str, ...]): The languages whose labels and aliases are indexed.
+        workers (int): The number of parsing processes.
+        chunk_size (int): The number of dump lines sent to a worker at once.
+    """
+    if os.path.dirname(index_path):
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = index_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE items (qid INTEGER PRIMARY KEY, sitelinks INTEGER)")
+    conn.execute("CREATE TABLE labels (qid INTEGER, lang TEXT, label TEXT)")
+    conn.execute("CREATE TABLE names (norm TEXT, lang TEXT, qid INTEGER, is_alias INTEGER)")
+    conn.execute("CREATE TABLE claims (qid INTEGER, prop INTEGER, target INTEGER)")
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.executemany("INSERT INTO meta VALUES (?, ?)", [("dump", os.path.abspath(dump_path)), ("langs", json.dumps(list(langs)))])
+
+    with open_dump(dump_path) as dump, multiprocessing.Pool(workers) as pool:
+        parse = functools.partial(parse_chunk, langs=tuple(langs))
+        for items, labels, names, claims in tqdm(pool.imap(parse, iter_chunks(dump, chunk_size)), desc=f"Indexing {dump_path}", unit="chunk"):
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO items VALUES (?, ?)", items)
+                conn.executemany("INSERT INTO labels VALUES (?, ?, ?)", labels)
+                conn.executemany("INSERT INTO names VALUES (?, ?, ?, ?)", names)
+                conn.executemany("INSERT INTO claims VALUES (?, ?, ?)", claims)
+
+    print("Creating indexes")
+    with conn:
+        conn.execute("CREATE INDEX labels_qid ON labels (qid, lang)")
+        conn.execute("CREATE INDEX names_norm ON names (norm, lang)")
+        conn.execute("CREATE INDEX claims_qid ON claims (qid, prop)")
+        conn.execute("CREATE INDEX claims_target ON claims (prop, target)")
+    conn.close()
+    os.replace(tmp_path, index_path)
+
+
+class WikidataIndex:
+    """
+    Read-only access to an index written by `build_index`. Lookups are cached in memory, every thread
+    gets its own SQLite connection.
+    """
+
+    def __init__(self, index_path: str = DEFAULT_INDEX_PATH, cache_size: int = 1_000_000):
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError(f"The Wikidata index was not found: {index_path}, build it with `python -m wikidata_dump_index`.")
+        self.index_path = index_path
+        self._local = threading.local()
+        self.search = functools.lru_cache(maxsize=cache_size)(self._search)
+        self.get_claims = functools.lru_cache(maxsize=cache_size)(self._get_claims)
+        self.get_label = functools.lru_cache(maxsize=cache_size)(self._get_label)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True)
+            self._local.conn = conn
+        return conn
+
+    def _search(self, query: str, lang: str, limit: int) -> Tuple[str, ...]:
+        """
+        Returns the ids of the items whose label or alias in `lang` equals the normalized query,
+        items matched by label first, then by number of sitelinks.
+        """
+        rows = self._connection().execute(
+            "SELECT n.qid FROM names n LEFT JOIN items i ON i.qid = n.qid WHERE n.norm = ? AND n.lang = ? "
+            "GROUP BY n.qid ORDER BY MIN(n.is_alias), COALESCE(i.sitelinks, 0) DESC, n.qid LIMIT ?",
+            (normalize_label(query), lang, limit)
+        ).fetchall()
+        return tuple(f"Q{qid}" for qid, in rows)
+
+    def _get_claims(self, entity_id: str, prop: int = 31) -> Tuple[str, ...]:
+        """
+        Returns the ids of the values of property `prop` (31 or 279) of an item.
+        """
+        if not entity_id.startswith('Q') or not entity_id[1:].isdigit():
+            return ()
+        rows = self._connection().execute("SELECT target FROM claims WHERE qid = ? AND prop = ? ORDER BY rowid", (int(entity_id[1:]), prop)).fetchall()
+        return tuple(f"Q{target}" for target, in rows)
+
+    def _get_label(self, entity_id: str, lang: str) -> Optional[str]:
+        if not entity_id.startswith('Q') or not entity_id[1:].isdigit():
+            return None
+        row = self._connection().execute("SELECT label FROM labels WHERE qid = ? AND lang = ?", (int(entity_id[1:]), lang)).fetchone()
+        return row[0] if row else None
+
+    def get_labels(self, entity_ids: Iterable[str], lang: str, batch_size: int = 500) -> Dict[str, str]:
+        """
+        Returns the labels in `lang` of many items at once (batched `IN` queries, not cached), in the order of `entity_ids`.
+        """
+        labels = {}
+        numbers = [int(entity_id[1:]) for entity_id in entity_ids if entity_id.startswith('Q') and entity_id[1:].isdigit()]
+        conn = self._connection()
+        for start in range(0, len(numbers), batch_size):
+            batch = numbers[start:start + batch_size]
+            rows = dict(conn.execute(
+                f"SELECT qid, label FROM labels WHERE lang = ? AND qid IN ({','.join('?' * len(batch))})", (lang, *batch)
+            ).fetchall())
+            for number in batch:
+                if number in rows:
+                    labels[f"Q{number}"] = rows[number]
+        return labels
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the offline Wikidata index from a JSON dump.', add_help=False)
+    parser.add_argument('--dump', type=str, help='Path to the Wikidata JSON dump (.json, .json.bz2, .json.gz or - for stdin).')
+    parser.add_argument('--out', type=str, help='Path of the index to write.', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--langs', type=str, nargs='+', help='Languages of the indexed labels.', default=["en"])
+    parser.add_argument('--workers', type=int, help='Number of parsing processes.', default=os.cpu_count() or 1)
+    sg = parser.parse_args()
+    build_index(sg.dump, sg.out, tuple(sg.langs), sg.workers)